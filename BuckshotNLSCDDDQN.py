@@ -1,49 +1,119 @@
 import random
 import os
+import re
+import argparse
+import json
+import io
+import copy
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from collections import deque
+from collections import deque, OrderedDict
+from functools import lru_cache
 import time
+import threading
+import queue
+from contextlib import nullcontext
+from NumpyPolicy import NumpyPolicy
+from PolicyTable import PolicyTable, packStates, unpackStates, writePolicyTable
+from StateEncoding import stateScale, stateOffset, stateLimits
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu"); print(f"Using: {device}")
 
 
+class StateField():
+    """A Game attribute that is mirrored into Game.state[index] / scale whenever it is assigned.
+    It only defines __set__, so reads stay plain instance attribute lookups."""
+
+    def __init__(self, index: int, scale: float = 1):
+        self.index, self.scale = index, scale
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __set__(self, game, value):
+        game.__dict__[self.name] = value
+        game.state[self.index] = value / self.scale
+
+
 class Game():
+
+    AI_hp, DEALER_hp = StateField(0, 4), StateField(1, 4)
+    live_shells, blank_shells = StateField(2, 4), StateField(3, 4)
+    shell = StateField(4)
+    current_round_num = StateField(5, 8)
+    is_sawed, invert_odds = StateField(6), StateField(7)
     
-    def __init__(self): self.resetGame()
+    def __init__(self, *, count_encoding: bool = False, dtype=np.float16):
+        """count_encoding: getState emits the 6 item counts of each player (20 values) instead of 8 item slots each (24 values).
+        dtype: dtype of the state vector, np.float32 lets act/replay use it without conversion."""
+        self.count_encoding = count_encoding
+        self.state_size = 20 if count_encoding else 24
+        self.state = np.zeros(self.state_size, dtype=dtype)  # kept up to date by every mutator, see StateField
+        self.resetGame()
     
     def resetShells(self):
         """Adds a random number of live and blank shells to the shotgun."""
-        self.live_shells, self.blank_shells = random.randint(1, 4), random.randint(1, 4)
+        self.live_shells, self.blank_shells = self.roll(1, 4), self.roll(1, 4)
         self.shells = self.totalShells()
         self.current_round_num = 0
         self.shell = 0
         
     def restockItems(self):
-        """Restocks the round for the AI and DEALER."""
-        self.AI_items = list(filter(None, self.AI_items))
-        self.DEALER_items = list(filter(None, self.DEALER_items))
-        for _ in range(4):
-            if len(self.AI_items) < 8:
-                self.AI_items.append(random.randint(1, 6))
-            if len(self.DEALER_items) < 8:
-                self.DEALER_items.append(random.randint(1, 6))
-            
-        while len(self.AI_items) < 8:
-            self.AI_items.append(0)
-        while len(self.DEALER_items) < 8:
-            self.DEALER_items.append(0)
+        """Restocks the round for the AI and DEALER, up to 4 new items each and at most 8 held."""
+        for items in (self.AI_items, self.DEALER_items):
+            for _ in range(min(4, 8 - sum(items))):
+                items[self.roll(1, 6) - 1] += 1
+            self.writeItems(items)
+
+    def useItem(self, items: list, item: int):
+        """Consumes one `item` from an inventory, returns whether there was one to consume."""
+        if items[item - 1]:
+            items[item - 1] -= 1
+            self.writeItems(items)
+            return True
+        return False
+
+    def writeItems(self, items: list):
+        """Mirrors one inventory into its slice of Game.state."""
+        if self.count_encoding:
+            start = 8 if items is self.AI_items else 14
+            self.state[start:start + 6] = [count/8 for count in items]
+        else:
+            start = 8 if items is self.AI_items else 16
+            self.state[start:start + 8] = self.slotState(tuple(items))
+
+    @staticmethod
+    def itemSlots(items: list):
+        """The 8 inventory slots derived from the item counts, in item order, empty slots last."""
+        slots = [item for item, count in enumerate(items, 1) for _ in range(count)]
+        return slots + [0] * (8 - len(slots))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def slotState(items: tuple):
+        """The getState encoding of an inventory; there are only 3003 of them, so each is built once."""
+        return tuple(item/6 for item in Game.itemSlots(items))
+
+    stateScale = staticmethod(stateScale)
     
+    def chance(self, p: float):
+        """True with probability p. Every coin flip in the rules goes through here and every die roll through roll(),
+        so BuckshotSolver can enumerate the outcomes instead of sampling them."""
+        return random.random() < p
+
+    def roll(self, low: int, high: int):
+        return random.randint(low, high)
+
     def totalShells(self): 
         return self.live_shells + self.blank_shells
     
     def determineShell(self):
         if not self.invert_odds:
-            return 1 if random.random() <= (self.live_shells / self.totalShells()) else 0.5
+            return 1 if self.chance(self.live_shells / self.totalShells()) else 0.5
         else:
-            return 0.5 if random.random() <= (self.blank_shells / self.totalShells()) else 1
+            return 0.5 if self.chance(self.blank_shells / self.totalShells()) else 1
     
     def riggedDetermine(self, live: bool): 
         return 1 if live else 0.5
@@ -55,8 +125,8 @@ class Game():
     def resetGame(self):
         """Resets the game state, initializes the shotgun, and loads bullets."""
         self.resetShells()
-        self.AI_items = []
-        self.DEALER_items = []  # 0:nothing, 1:beer 2:magnifier 3:smoke 4:inverter 5:cuffs 6:saw
+        self.AI_items = [0] * 6
+        self.DEALER_items = [0] * 6  # counts of 1:beer 2:magnifier 3:smoke 4:inverter 5:cuffs 6:saw
         self.AI_hp = self.DEALER_hp = 4
         self.AI_can_play = True
         self.DEALER_can_play = True
@@ -72,8 +142,8 @@ class Game():
         print(f"AI HP: {self.AI_hp}, DEALER HP: {self.DEALER_hp}")
         print(f"Live Shells: {self.live_shells}, Blank Shells: {self.blank_shells}")
         print(f"Current Shell: {self.shell}")
-        print(f"AI Items: {[i for i in self.AI_items if i != 0]}")
-        print(f"DEALER Items: {[i for i in self.DEALER_items if i != 0]}")
+        print(f"AI Items: {[i for i in self.itemSlots(self.AI_items) if i != 0]}")
+        print(f"DEALER Items: {[i for i in self.itemSlots(self.DEALER_items) if i != 0]}")
         print(f"Current Round: {self.current_round_num}")
         print(f"Sawed Off: {self.is_sawed}")
         print(f"Inverted: {self.invert_odds}")
@@ -92,15 +162,11 @@ class Game():
     def drinkBeer(self, player: bool = False):
         """Player drinks beer, returns reward."""
         if player:
-            if 1 in self.AI_items:
+            if self.useItem(self.AI_items, 1):
                 if self.totalShells() == 1:
-                    self.AI_items.remove(1)
-                    self.AI_items.append(0)
                     self.outOfShells()
                     return 1 if self.shell == 0 else -1
                 else:
-                    self.AI_items.remove(1)
-                    self.AI_items.append(0)
                     if self.shell == 0:
                         self.removeUnknownShell()
                         return 1
@@ -118,9 +184,7 @@ class Game():
             else:
                 return -10
             
-        elif 1 in self.DEALER_items: 
-            self.DEALER_items.remove(1)
-            self.DEALER_items.append(0)
+        elif self.useItem(self.DEALER_items, 1):
             self.removeUnknownShell()
             
     def magnifier(self, player: bool = False):
@@ -128,24 +192,19 @@ class Game():
         if player:
             if self.shell != 0:
                 return -10
-            if 2 in self.AI_items:
-                self.AI_items.remove(2)
-                self.AI_items.append(0)
+            if self.useItem(self.AI_items, 2):
                 self.shell = self.determineShell()
                 return 5
             else:
                 return -10
             
-        elif 2 in self.DEALER_items: 
-            self.DEALER_items.remove(2)
-            self.DEALER_items.append(0)
+        else:
+            self.useItem(self.DEALER_items, 2)
     
     def smoke(self, player: bool = False):
         """Player smokes, regains 1 hp, returns reward."""
         if player:
-            if 3 in self.AI_items:
-                self.AI_items.remove(3)
-                self.AI_items.append(0)
+            if self.useItem(self.AI_items, 3):
                 if self.AI_hp < 4:
                     self.AI_hp += 1
                     return 5
@@ -155,9 +214,7 @@ class Game():
             else:
                 return -10
             
-        elif 3 in self.DEALER_items:
-                self.DEALER_items.remove(3)
-                self.DEALER_items.append(0)
+        elif self.useItem(self.DEALER_items, 3):
                 self.DEALER_hp = min(4, self.DEALER_hp+1)
     
     def invert(self):
@@ -175,52 +232,40 @@ class Game():
     def inverter(self, player: bool = False):
         """Player inverts current round, returns reward."""
         if player:
-            if 4 in self.AI_items:
-                self.AI_items.remove(4)
-                self.AI_items.append(0)
+            if self.useItem(self.AI_items, 4):
                 self.invert()
                 return 0
             else: 
                 return -10
             
-        elif 4 in self.DEALER_items: 
-            self.DEALER_items.remove(4)
-            self.DEALER_items.append(0)
+        elif self.useItem(self.DEALER_items, 4):
             self.invert()
     
     def cuff(self, player: bool = False):
         """Player cuffs opponent, skipping their turn, returns reward."""
         if player:
-            if 5 in self.AI_items:
+            if self.AI_items[4]:
                 if self.DEALER_did_play:
-                    self.AI_items.remove(5)
-                    self.AI_items.append(0)
+                    self.useItem(self.AI_items, 5)
                     self.DEALER_can_play = False
                     return 5
                 else: return -10
             else: 
                 return -10
             
-        elif 5 in self.DEALER_items:
-            if self.AI_did_play:
-                self.DEALER_items.remove(5)
-                self.DEALER_items.append(0)
-                self.AI_can_play = False
+        elif self.AI_did_play and self.useItem(self.DEALER_items, 5):
+            self.AI_can_play = False
     
     def saw(self, player: bool = False):
         """Player saws off shotgun, doubling damage, returns reward."""
         if player:
-            if 6 in self.AI_items:
-                self.AI_items.remove(6)
-                self.AI_items.append(0)
+            if self.useItem(self.AI_items, 6):
                 self.is_sawed = True
                 return 3 if self.shell != 0.5 else -2
             else: 
                 return -10
             
-        elif 6 in self.DEALER_items:
-                self.DEALER_items.remove(6)
-                self.DEALER_items.append(0)
+        elif self.useItem(self.DEALER_items, 6):
                 self.is_sawed = True
     
     def AIshootAI(self):
@@ -277,7 +322,8 @@ class Game():
             return -10
     
     def DEALERshootDEALER(self):
-        """Determines the outcome of the shot if not already known, and shoots DEALER."""
+        """Determines the outcome of the shot if not already known, and shoots DEALER.
+        The fired shell is gone, so the next one is unknown again (superCheat shoots twice in one turn)."""
         if self.shell == 0.5:
             self.blank_shells -= 1
             self.AI_can_play = False
@@ -292,6 +338,7 @@ class Game():
         elif self.shell == 1: 
             self.live_shells -= 1
             self.DEALER_hp -= 1
+        self.shell = 0
     
     def DEALERshootAI(self):
         """Determines the outcome of the shot if not already known, and shoots AI."""
@@ -306,7 +353,7 @@ class Game():
         
     def DEALERSmoke(self):
         """The DEALER smokes as many times as possible, stopping if he is at max hp."""
-        for _ in range(self.DEALER_items.count(3)):
+        for _ in range(self.DEALER_items[2]):
             if self.DEALER_hp == 4:
                 break
             self.smoke()
@@ -347,7 +394,7 @@ class Game():
 
     def dontCheat(self):
         """The simple algorithm for the DEALER, it randomly guesses if it is live or blank and then plays accordingly."""
-        if random.random() < 0.5:
+        if self.chance(0.5):
             self.guessLive()
         else:
             self.guessBlank()
@@ -355,10 +402,10 @@ class Game():
     def DEALERalgo(self):
         """The DEALER Algorithm used in place of a real dealer, it has to cheat, but it efficiently trains the AI."""
         if self.blank_shells > 0 and self.live_shells > 0:
-            if random.random() < 0.1 or self.DEALER_hp == 1:
+            if self.DEALER_hp == 1 or self.chance(0.1):
                 self.superCheat()
                 return 4
-            elif random.random() < 0.4:
+            elif self.chance(0.4):
                 self.normalCheat()
                 return 3
                 
@@ -366,19 +413,458 @@ class Game():
             self.dontCheat()
             return 2
         
+    def DEALERturn(self):
+        """Plays the DEALER's turn, or skips it if the DEALER is cuffed."""
+        if self.DEALER_can_play:
+            self.DEALERalgo()
+            self.DEALER_did_play = True
+            self.is_sawed = False
+            self.shell = 0
+            if self.totalShells() == 0:
+                self.outOfShells()
+        else:
+            self.DEALER_can_play = True
+
+    def step(self, action: int):
+        """Applies one AI action, returns (reward, done).
+        Shooting (0 or 7) ends the AI's turn, after which the DEALER plays until the AI can act again.
+        Dying costs the AI 30, killing the DEALER earns it 25."""
+        match action:
+            case 0:
+                reward = self.AIshootDEALER()
+            case 1:
+                reward = self.smoke(player=True)
+            case 2:
+                reward = self.magnifier(player=True)
+            case 3:
+                reward = self.drinkBeer(player=True)
+            case 4:
+                reward = self.inverter(player=True)
+            case 5:
+                reward = self.cuff(player=True)
+            case 6:
+                reward = self.saw(player=True)
+            case 7:
+                reward = self.AIshootAI()
+            case _:
+                raise Exception(f"Invalid action: {action}")
+        self.AI_did_play = True
+
+        if action in (0, 7) and self.AI_hp > 0 and self.DEALER_hp > 0:
+            self.shell = 0
+            self.is_sawed = False
+            if self.totalShells() == 0:
+                self.outOfShells()
+            self.DEALERturn()
+            while not self.AI_can_play and self.AI_hp > 0 and self.DEALER_hp > 0:
+                self.AI_can_play = True
+                self.DEALERturn()
+
+        if self.AI_hp <= 0:
+            return reward - 30, True
+        elif self.DEALER_hp <= 0:
+            return reward + 25, True
+        return reward, False
+
+    def legalActions(self):
+        """Boolean mask over the 8 actions of the ones that can do something now. The others are refused by the rules with
+        -10 and change nothing: an item the AI does not hold, the magnifier on a known shell, cuffs before the DEALER played."""
+        items = self.AI_items
+        return np.array([True, items[2] > 0, items[1] > 0 and self.shell == 0, items[0] > 0, items[3] > 0,
+                         items[4] > 0 and self.DEALER_did_play, items[5] > 0, True])
+
+    def getState(self, out=None, *, copy: bool = True):
+        """Returns the state vector: copied into `out` if given, else a copy, or with copy=False the live Game.state view."""
+        if out is not None:
+            out[:] = self.state
+            return out
+        return self.state.copy() if copy else self.state
+
+
+class VecGame():
+    """N independent Games stored as NumPy arrays (struct of arrays) and advanced together.
+    Every method mirrors the Game method of the same name, applied to the games selected by a boolean mask;
+    step() mirrors Game.step and resets finished games in place.
+    Fields are only written through _set/_add, which TorchVecGame swaps for tensor versions."""
+
+    where, stack = staticmethod(np.where), staticmethod(np.stack)
+    bool_, int_, float_ = bool, np.int8, np.float32
+    # Extra DEALER turns step() plays while the AI is cuffed or skipped; None plays until no game is waiting.
+    dealer_passes = None
+
+    def __init__(self, num_games: int, *, seed=None, dtype=np.float16, count_encoding: bool = False):
+        self.num_games = num_games
+        self.dtype = dtype
+        self.count_encoding = count_encoding
+        self.state_size = 20 if count_encoding else 24
+        self.rng = np.random.default_rng(seed)
+        n = num_games
+        self.AI_hp, self.DEALER_hp = self._zeros(n, self.int_), self._zeros(n, self.int_)
+        self.live_shells, self.blank_shells = self._zeros(n, self.int_), self._zeros(n, self.int_)
+        self.shells = self._zeros(n, self.int_)
+        self.current_round_num = self._zeros(n, self.int_)
+        self.shell = self._zeros(n, self.float_)  # 0:unknown, 0.5:blank, 1:live
+        self.is_sawed, self.invert_odds = self._zeros(n, self.bool_), self._zeros(n, self.bool_)
+        self.AI_can_play, self.DEALER_can_play = self._zeros(n, self.bool_), self._zeros(n, self.bool_)
+        self.AI_did_play, self.DEALER_did_play = self._zeros(n, self.bool_), self._zeros(n, self.bool_)
+        self.AI_items, self.DEALER_items = self._zeros((6, n), self.int_), self._zeros((6, n), self.int_)  # item-major counts
+        self.resetGame()
+
+    def _zeros(self, shape, dtype):
+        return np.zeros(shape, dtype)
+
+    def _arange(self, n: int):
+        return np.arange(n)
+
+    def _random(self, shape):
+        return self.rng.random(shape)
+
+    def _randint(self, low: int, high: int, shape):
+        return self.rng.integers(low, high, shape, dtype=np.int8)
+
+    def _asarray(self, x):
+        return np.asarray(x)
+
+    def _set(self, x, mask, value):
+        """x = value where mask, in place. Masks select along the last (game) axis."""
+        x[..., mask] = value[..., mask] if isinstance(value, np.ndarray) else value
+
+    def _add(self, x, mask, value):
+        x[..., mask] += value[..., mask] if isinstance(value, np.ndarray) else value
+
+    def _reward(self, mask, reward):
+        return np.where(mask, reward, 0).astype(np.float32)
+
+    def resetShells(self, mask):
+        self._set(self.live_shells, mask, self._randint(1, 5, self.num_games))
+        self._set(self.blank_shells, mask, self._randint(1, 5, self.num_games))
+        self._set(self.shells, mask, self.totalShells())
+        self._set(self.current_round_num, mask, 0)
+        self._set(self.shell, mask, 0)
+
+    def restockItems(self, mask):
+        """Gives every selected player up to 4 new items, keeping at most 8."""
+        rows = np.flatnonzero(mask)
+        for items in (self.AI_items, self.DEALER_items):
+            count = items[:, rows].sum(0)
+            new_items = self._randint(0, 6, (4, rows.size))
+            for i in range(4):
+                free = count + i < 8
+                items[new_items[i, free], rows[free]] += 1
+
+    def totalShells(self):
+        return self.live_shells + self.blank_shells
+
+    def determineShell(self):
+        """Draws a shell for every game, returns True where it is live. The inverted odds draw of Game has the same distribution."""
+        total = self.totalShells()
+        p_live = self.where(total != 0, self.live_shells / total.clip(min=1), 0)
+        return self._random(self.num_games) <= p_live
+
+    def outOfShells(self, mask):
+        self.resetShells(mask)
+        self.restockItems(mask)
+
+    def resetGame(self, mask=None):
+        if mask is None:
+            mask = self._zeros(self.num_games, self.bool_) | True
+        self._set(self.AI_items, mask, 0)
+        self._set(self.DEALER_items, mask, 0)
+        self.resetShells(mask)
+        self._set(self.AI_hp, mask, 4)
+        self._set(self.DEALER_hp, mask, 4)
+        self._set(self.AI_can_play, mask, True)
+        self._set(self.DEALER_can_play, mask, True)
+        self._set(self.AI_did_play, mask, False)
+        self._set(self.DEALER_did_play, mask, False)
+        self._set(self.invert_odds, mask, False)
+        self._set(self.is_sawed, mask, False)
+        self.restockItems(mask)
+
+    def _consume(self, items, item: int, mask):
+        """Game.useItem for the selected games, returns where an `item` was consumed."""
+        has = mask & (items[item - 1] > 0)
+        self._add(items[item - 1], has, -1)
+        return has
+
+    def removeUnknownShell(self, mask):
+        live = self.determineShell()
+        self._add(self.live_shells, mask & live, -1)
+        self._add(self.blank_shells, mask & ~live, -1)
+        self._set(self.shell, mask, 0)
+
+    def drinkBeer(self, mask, player: bool = False):
+        if player:
+            has = self._consume(self.AI_items, 1, mask)
+            last = has & (self.totalShells() == 1)
+            rest = has & ~last
+            unknown, live, blank = rest & (self.shell == 0), rest & (self.shell == 1), rest & (self.shell == 0.5)
+            self.outOfShells(last)
+            self.removeUnknownShell(unknown)
+            self._add(self.live_shells, live, -1)
+            self._add(self.blank_shells, blank, -1)
+            self._set(self.shell, rest, 0)
+            return self._reward(mask, self.where(has, self.where(last | unknown, 1, -1), -10))
+        self.removeUnknownShell(self._consume(self.DEALER_items, 1, mask))
+
+    def magnifier(self, mask, player: bool = False):
+        if player:
+            has = self._consume(self.AI_items, 2, mask & (self.shell == 0))
+            self._set(self.shell, has, self.where(self.determineShell(), 1.0, 0.5))
+            return self._reward(mask, self.where(has, 5, -10))
+        self._consume(self.DEALER_items, 2, mask)
+
+    def smoke(self, mask, player: bool = False):
+        if player:
+            has = self._consume(self.AI_items, 3, mask)
+            heal = has & (self.AI_hp < 4)
+            self._add(self.AI_hp, heal, 1)
+            return self._reward(mask, self.where(heal, 5, self.where(has, -5, -10)))
+        has = self._consume(self.DEALER_items, 3, mask)
+        self._add(self.DEALER_hp, has & (self.DEALER_hp < 4), 1)
+
+    def invert(self, mask):
+        blank, live = mask & (self.shell == 0.5), mask & (self.shell == 1)
+        self._set(self.invert_odds, mask & (self.shell == 0), True)
+        self._set(self.shell, blank, 1)
+        self._set(self.shell, live, 0.5)
+        self._add(self.blank_shells, blank, -1)
+        self._add(self.live_shells, blank, 1)
+        self._add(self.blank_shells, live, 1)
+        self._add(self.live_shells, live, -1)
+
+    def inverter(self, mask, player: bool = False):
+        if player:
+            has = self._consume(self.AI_items, 4, mask)
+            self.invert(has)
+            return self._reward(mask, self.where(has, 0, -10))
+        self.invert(self._consume(self.DEALER_items, 4, mask))
+
+    def cuff(self, mask, player: bool = False):
+        if player:
+            has = self._consume(self.AI_items, 5, mask & self.DEALER_did_play)
+            self._set(self.DEALER_can_play, has, False)
+            return self._reward(mask, self.where(has, 5, -10))
+        self._set(self.AI_can_play, self._consume(self.DEALER_items, 5, mask & self.AI_did_play), False)
+
+    def saw(self, mask, player: bool = False):
+        if player:
+            has = self._consume(self.AI_items, 6, mask)
+            self._set(self.is_sawed, has, True)
+            return self._reward(mask, self.where(has, self.where(self.shell != 0.5, 3, -2), -10))
+        self._set(self.is_sawed, self._consume(self.DEALER_items, 6, mask), True)
+
+    def _damage(self):
+        return self.where(self.is_sawed, 2, 1)
+
+    def _fire(self, mask):
+        """Resolves unknown shells of the selected games and removes the fired shell, returns (unknown, live) masks."""
+        unknown = mask & (self.shell == 0)
+        self._set(self.shell, unknown, self.where(self.determineShell(), 1.0, 0.5))
+        live = mask & (self.shell == 1)
+        self._add(self.live_shells, live, -1)
+        self._add(self.blank_shells, mask & ~live, -1)
+        return unknown, live
+
+    def AIshootAI(self, mask):
+        unknown, live = self._fire(mask)
+        self._add(self.AI_hp, live, -self._damage())
+        reward = self.where(unknown,
+                            self.where(live, self.where(self.is_sawed, -10, -3), self.where(self.is_sawed, -2, 0)),
+                            self.where(live, self.where(self.is_sawed, -20, -10), self.where(self.is_sawed, -2, 10)))
+        return self._reward(mask, reward)
+
+    def AIshootDEALER(self, mask):
+        unknown, live = self._fire(mask)
+        self._add(self.DEALER_hp, live, -self._damage())
+        reward = self.where(live, self.where(unknown, 3, 4) * self._damage(), self.where(unknown, 0, -10))
+        return self._reward(mask, reward)
+
+    def DEALERshootDEALER(self, mask):
+        self._set(self.AI_can_play, mask & (self.shell == 0.5), False)
+        known_live = mask & (self.shell == 1)
+        unknown, live = self._fire(mask)
+        self._add(self.DEALER_hp, known_live, -1)
+        self._add(self.DEALER_hp, unknown & live, -self._damage())
+        self._set(self.shell, mask, 0)
+
+    def DEALERshootAI(self, mask):
+        live = mask & ((self.shell == 1) | ((self.shell == 0) & self.determineShell()))
+        self._add(self.live_shells, live, -1)
+        self._add(self.blank_shells, mask & ~live, -1)
+        self._add(self.AI_hp, live, -self._damage())
+
+    def DEALERSmoke(self, mask):
+        """Smokes while the DEALER is below max hp; the DEALER only plays alive, so 3 smokes always suffice."""
+        for _ in range(3):
+            self._add(self.DEALER_hp, self._consume(self.DEALER_items, 3, mask & (self.DEALER_hp < 4)), 1)
+
+    def normalCheat(self, mask):
+        self.magnifier(mask)
+        self.DEALERSmoke(mask)
+        self.cuff(mask)
+        self.DEALERshootAI(mask)
+
+    def superCheat(self, mask):
+        self.magnifier(mask)
+        self.DEALERSmoke(mask)
+        self.DEALERshootDEALER(mask)
+        self.magnifier(mask)
+        self.saw(mask)
+        self.cuff(mask)
+        self.DEALERshootAI(mask)
+
+    def guessLive(self, mask):
+        self.inverter(mask)
+        self.DEALERSmoke(mask)
+        self.cuff(mask)
+        self.saw(mask)
+        self.DEALERshootAI(mask)
+
+    def guessBlank(self, mask):
+        self.inverter(mask)
+        self.DEALERSmoke(mask)
+        self.DEALERshootDEALER(mask)
+
+    def dontCheat(self, mask):
+        guess_live = self._random(self.num_games) < 0.5
+        self.guessLive(mask & guess_live)
+        self.guessBlank(mask & ~guess_live)
+
+    def DEALERalgo(self, mask):
+        both = (self.blank_shells > 0) & (self.live_shells > 0)
+        draws = self._random((2, self.num_games))
+        super_cheat = mask & both & ((draws[0] < 0.1) | (self.DEALER_hp == 1))
+        self.superCheat(super_cheat)
+        self.normalCheat(mask & both & ~super_cheat & (draws[1] < 0.4))
+        self.dontCheat(mask & ~both)
+
+    def DEALERturn(self, mask):
+        playing = mask & self.DEALER_can_play
+        self.DEALERalgo(playing)
+        self._set(self.DEALER_did_play, playing, True)
+        self._set(self.is_sawed, playing, False)
+        self._set(self.shell, playing, 0)
+        self.outOfShells(playing & (self.totalShells() == 0))
+        self._set(self.DEALER_can_play, mask, True)
+
+    def alive(self):
+        return (self.AI_hp > 0) & (self.DEALER_hp > 0)
+
+    def step(self, actions):
+        """Applies one AI action per game, returns (states, rewards, dones). Finished games are reset before the states are built."""
+        actions = self._asarray(actions)
+        rewards = (self.AIshootDEALER(actions == 0)
+                   + self.smoke(actions == 1, player=True)
+                   + self.magnifier(actions == 2, player=True)
+                   + self.drinkBeer(actions == 3, player=True)
+                   + self.inverter(actions == 4, player=True)
+                   + self.cuff(actions == 5, player=True)
+                   + self.saw(actions == 6, player=True)
+                   + self.AIshootAI(actions == 7))
+        self.AI_did_play[:] = True
+
+        turn_done = ((actions == 0) | (actions == 7)) & self.alive()
+        self._set(self.shell, turn_done, 0)
+        self._set(self.is_sawed, turn_done, False)
+        self.outOfShells(turn_done & (self.totalShells() == 0))
+        self.DEALERturn(turn_done)
+        waiting = turn_done & self.alive() & ~self.AI_can_play
+        passes = 0
+        while waiting.any() if self.dealer_passes is None else passes < self.dealer_passes:
+            self._set(self.AI_can_play, waiting, True)
+            self.DEALERturn(waiting)
+            waiting = waiting & self.alive() & ~self.AI_can_play
+            passes += 1
+        self._set(self.AI_can_play, waiting, True)
+
+        AI_dead = self.AI_hp <= 0
+        DEALER_dead = ~AI_dead & (self.DEALER_hp <= 0)
+        rewards = self.where(AI_dead, rewards - 30, self.where(DEALER_dead, rewards + 25, rewards))
+        dones = AI_dead | DEALER_dead
+        self.resetGame(dones)
+        return self.getState(), rewards, dones
+
+    def legalActions(self):
+        """Game.legalActions for every game, as an (N, 8) boolean mask."""
+        items, shoot = self.AI_items > 0, self._zeros(self.num_games, self.bool_) | True
+        return self.stack((shoot, items[2], items[1] & (self.shell == 0), items[0], items[3],
+                           items[4] & self.DEALER_did_play, items[5], shoot), 1)
+
+    def itemSlots(self, items):
+        """Game.itemSlots for every game: (8, N) slots filled in item order from the (6, N) counts."""
+        slots = self._arange(8)[:, None, None]
+        filled = items.cumsum(0)
+        return ((filled <= slots).sum(1) + 1) * (slots[:, 0] < filled[-1])
+
     def getState(self):
-        return np.array([
-            self.AI_hp/4, self.DEALER_hp/4,
-            self.live_shells/4, self.blank_shells/4,
-            self.shell,
-            self.current_round_num/8,
-            self.is_sawed,
-            self.invert_odds,
-            *[item/6 for item in self.AI_items], 
-            *[item/6 for item in self.DEALER_items]
-        ], dtype=np.float16)
+        state = self._zeros((self.num_games, self.state_size), self.dtype)
+        state[:, 0], state[:, 1] = self.AI_hp / 4, self.DEALER_hp / 4
+        state[:, 2], state[:, 3] = self.live_shells / 4, self.blank_shells / 4
+        state[:, 4] = self.shell
+        state[:, 5] = self.current_round_num / 8
+        state[:, 6], state[:, 7] = self.is_sawed, self.invert_odds
+        if self.count_encoding:
+            state[:, 8:14], state[:, 14:20] = self.AI_items.T / 8, self.DEALER_items.T / 8
+        else:
+            state[:, 8:16] = self.itemSlots(self.AI_items).T / 6
+            state[:, 16:24] = self.itemSlots(self.DEALER_items).T / 6
+        return state
+
+
+class TorchVecGame(VecGame):
+    """VecGame with every field held as a torch tensor on `device`, so getState() feeds SCDDDQN directly
+    and act -> step -> remember never leaves torch. Fields are updated with dense masked ops. Off the CPU step() also
+    plays a fixed `dealer_passes` extra DEALER turns instead of asking the host whether any AI is still cuffed, so
+    stepping never syncs; each extra turn is about 7 times rarer than the one before (7 was the most seen in 5M turns),
+    and a game still waiting after all of them gets its turn back. On the CPU asking is free and cheaper than the passes."""
+
+    where, stack = staticmethod(torch.where), staticmethod(torch.stack)
+    bool_, int_, float_ = torch.bool, torch.int64, torch.float32
+
+    def __init__(self, num_games: int, *, seed=None, device=device, count_encoding: bool = False, dealer_passes: int = 12):
+        self.device = device
+        self.dealer_passes = None if torch.device(device).type == "cpu" else dealer_passes
+        self.generator = torch.Generator(device=device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        super().__init__(num_games, dtype=torch.float32, count_encoding=count_encoding)
+
+    def _zeros(self, shape, dtype):
+        return torch.zeros(shape, dtype=dtype, device=self.device)
+
+    def _arange(self, n: int):
+        return torch.arange(n, device=self.device)
+
+    def _random(self, shape):
+        return torch.rand(shape, generator=self.generator, device=self.device)
+
+    def _randint(self, low: int, high: int, shape):
+        return torch.randint(low, high, shape if isinstance(shape, tuple) else (shape,), generator=self.generator, device=self.device)
+
+    def _asarray(self, x):
+        return torch.as_tensor(x, device=self.device)
+
+    def _set(self, x, mask, value):
+        x.copy_(torch.where(mask, value, x))
+
+    def _add(self, x, mask, value):
+        x.add_(mask * value)
+
+    def _reward(self, mask, reward):
+        return torch.where(mask, reward, 0).to(torch.float32)
+
+    def restockItems(self, mask):
+        kinds = torch.arange(6, device=self.device)[:, None]
+        for items in (self.AI_items, self.DEALER_items):
+            count = items.sum(0)
+            new_items = self._randint(0, 6, (4, self.num_games))
+            for i in range(4):
+                self._add(items, (kinds == new_items[i]) & (mask & (count + i < 8)), 1)
+
 
-        
 class NoisyLinear(nn.Module):
     
     def __init__(self, in_features, out_features, *,std_init=0.4):
@@ -392,6 +878,7 @@ class NoisyLinear(nn.Module):
         self.register_buffer("bias_epsilon", torch.empty(self.out_features, device=device))
         self.std_init = std_init
         self.reset_parameters()
+        self.reset_noise()
 
     def reset_parameters(self):
         bound = 1 / self.weight_mu.size(1) ** 0.5
@@ -400,9 +887,20 @@ class NoisyLinear(nn.Module):
         self.bias_mu.data.uniform_(-bound, bound)
         self.bias_sigma.data.fill_(self.std_init / self.bias_mu.size(0) ** 0.5)
 
+    @staticmethod
+    def scaleNoise(size: int):
+        x = torch.randn(size, device=device)
+        return x.sign() * x.abs().sqrt()
+
+    def reset_noise(self):
+        """Factorized Gaussian noise: in + out draws, combined as an outer product, kept until the next reset_noise()."""
+        epsilon_in, epsilon_out = self.scaleNoise(self.in_features), self.scaleNoise(self.out_features)
+        self.weight_epsilon.copy_(torch.outer(epsilon_out, epsilon_in))
+        self.bias_epsilon.copy_(epsilon_out)
+
     def forward(self, x):
-        self.weight_epsilon.normal_()
-        self.bias_epsilon.normal_()
+        if not self.training:
+            return torch.nn.functional.linear(x, self.weight_mu, self.bias_mu)
         weight = self.weight_mu + self.weight_sigma * self.weight_epsilon
         bias = self.bias_mu + self.bias_sigma * self.bias_epsilon
         return torch.nn.functional.linear(x, weight, bias)
@@ -419,6 +917,7 @@ class SCDDDQN(nn.Module):
         Optional NLSC (noisy, fully noisy, noise, skip connections) \n
         Misc (activation) """
         super(SCDDDQN, self).__init__()
+        self.input_dim = input_dim
         self.hidden_dims = hidden_dims
         self.activation = activation
         self.skip_connections = skip_connections
@@ -434,101 +933,838 @@ class SCDDDQN(nn.Module):
         self.value_fc = NoisyLinear(prev_dim, 1, std_init=noise_std_init) if use_noisy else nn.Linear(prev_dim, 1, device=device)
         self.advantage_fc = NoisyLinear(prev_dim, output_dim, std_init=noise_std_init) if use_noisy else nn.Linear(prev_dim, output_dim, device=device)
 
-        if skip_connections:
-            for (from_layer, to_layer) in self.skip_connections:
-                if from_layer == 0:
-                    projection_layer = (NoisyLinear(input_dim, hidden_dims[to_layer - 1]) if fully_noisy else nn.Linear(input_dim, hidden_dims[to_layer - 1], device=device))
-                    self.skip_projections.append(projection_layer)
-                else: self.skip_projections.append(None)
+        # Static skip plan: for each hidden layer, the (source layer, projection index or None) pairs added to its output.
+        # Layer 0 is the input; projections keep their position in skip_connections so checkpoints stay compatible.
+        self.skip_plan = [[] for _ in hidden_dims]
+        dims = [input_dim] + list(hidden_dims)
+        for i, (from_layer, to_layer) in enumerate(self.skip_connections):
+            if not 0 <= from_layer < to_layer <= len(hidden_dims):
+                raise ValueError(f"Invalid skip connection {(from_layer, to_layer)} for {len(hidden_dims)} hidden layers")
+            if from_layer == 0:
+                projection_layer = (NoisyLinear(input_dim, hidden_dims[to_layer - 1]) if fully_noisy else nn.Linear(input_dim, hidden_dims[to_layer - 1], device=device))
+                self.skip_projections.append(projection_layer)
+                self.skip_plan[to_layer - 1].append((from_layer, i))
+            else:
+                if dims[from_layer] != dims[to_layer]:
+                    raise ValueError(f"Shape mismatch: cannot add output from layer {from_layer} with width {dims[from_layer]} to layer {to_layer} with width {dims[to_layer]}")
+                self.skip_projections.append(None)
+                self.skip_plan[to_layer - 1].append((from_layer, None))
+        self.skip_sources = {from_layer for (from_layer, _) in self.skip_connections}
+
+    def reset_noise(self):
+        """Resample the noise of every NoisyLinear layer; forwards reuse it until the next call."""
+        for module in self.modules():
+            if isinstance(module, NoisyLinear):
+                module.reset_noise()
 
     def forward(self, x):
-        outputs = [x]
-        for i, layer in enumerate(self.hidden_layers):
+        saved = {0: x} if 0 in self.skip_sources else {}
+        for i, (layer, skips) in enumerate(zip(self.hidden_layers, self.skip_plan), 1):
             x = self.activation(layer(x))
-            if self.skip_connections:
-                for (from_layer, to_layer) in self.skip_connections:
-                    if to_layer == i + 1:
-                        if from_layer == 0: 
-                            x = x + self.skip_projections[0](outputs[from_layer])
-                        elif outputs[from_layer].shape[1] == x.shape[1]:
-                            x = x + outputs[from_layer]
-                        else:
-                            raise ValueError(f"Shape mismatch: cannot add output from layer {from_layer} with shape {outputs[from_layer].shape} to current layer with shape {x.shape}")
-                        
-            outputs.append(x)
+            for (source, projection) in skips:
+                x = x + (saved[source] if projection is None else self.skip_projections[projection](saved[source]))
+            if i in self.skip_sources:
+                saved[i] = x
 
         value = self.value_fc(x)
         advantage = self.advantage_fc(x)
         advantage_mean = advantage.mean(dim=1, keepdim=True)
         return value + (advantage - advantage_mean)
 
+    def trace(self):
+        """TorchScript export of the eval-mode forward (noisy layers use their mu weights); save it with .save(path)."""
+        training = self.training
+        self.eval()
+        traced = torch.jit.trace(self, torch.zeros(1, self.input_dim, device=device))
+        self.train(training)
+        return traced
+
+
+def exportNumpyWeights(model: SCDDDQN, path: str):
+    """Write `model` as a flat .npz for NumpyPolicy: every Linear (NoisyLinear as its mu weights) transposed to (in, out)
+    as float32, plus the skip plan as (to_layer, source, projection or -1) rows."""
+    if not isinstance(model.activation, nn.ReLU):
+        raise ValueError(f"NumpyPolicy only implements ReLU, not {model.activation}")
+
+    def linear(layer):
+        weight, bias = (layer.weight_mu, layer.bias_mu) if isinstance(layer, NoisyLinear) else (layer.weight, layer.bias)
+        return weight.detach().cpu().numpy().T.astype(np.float32), bias.detach().cpu().numpy().astype(np.float32)
+
+    arrays = {"num_hidden": np.array(len(model.hidden_layers))}
+    for i, layer in enumerate(model.hidden_layers):
+        arrays[f"hidden.{i}.weight"], arrays[f"hidden.{i}.bias"] = linear(layer)
+    projections = [i for i, layer in enumerate(model.skip_projections) if layer is not None]
+    for i in projections:
+        arrays[f"skip.{i}.weight"], arrays[f"skip.{i}.bias"] = linear(model.skip_projections[i])
+    arrays["projections"] = np.array(projections, dtype=np.int64)
+    arrays["skip_plan"] = np.array([(to_layer, source, -1 if projection is None else projection)
+                                    for to_layer, skips in enumerate(model.skip_plan, 1) for (source, projection) in skips], dtype=np.int64).reshape(-1, 3)
+    arrays["value.weight"], arrays["value.bias"] = linear(model.value_fc)
+    arrays["advantage.weight"], arrays["advantage.bias"] = linear(model.advantage_fc)
+    np.savez(path, **arrays)
+
+
+def saveFlatWeights(model: nn.Module, path: str, alignment: int = 64):
+    """Write `model`'s state_dict as a flat weight file for loadFlatWeights: a little-endian uint64 header length, a JSON
+    header of every tensor's dtype, shape and byte offset, then the raw tensors, each starting on an `alignment`-byte boundary.
+    Written to a temporary file and renamed into place, so a process mapping `path` never sees it half written."""
+    tensors = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in model.state_dict().items()}
+    entries, size = {}, 0
+    for name, array in tensors.items():
+        # offsets are relative to the data section, which starts at the first aligned byte after the header
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": size}
+        size += -(-array.nbytes // alignment) * alignment
+    header = json.dumps({"alignment": alignment, "tensors": entries}).encode()
+    data_start = -(-(8 + len(header)) // alignment) * alignment
+    with open(path + ".tmp", "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for name, array in tensors.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + size)
+    os.replace(path + ".tmp", path)
+
+def mapFlatWeights(path: str):
+    """The tensors of a saveFlatWeights file as CPU tensors over one copy-on-write memory map: nothing is read or copied
+    up front, every process mapping the file shares its page-cache pages, and a write (NoisyLinear's noise buffers,
+    an optimizer step) only gives the writing process a private copy of the pages it touches."""
+    raw = np.memmap(path, dtype=np.uint8, mode="c")
+    header_length = int.from_bytes(raw[:8].tobytes(), "little")
+    header = json.loads(raw[8:8 + header_length].tobytes())
+    alignment = header["alignment"]
+    data_start = -(-(8 + header_length) // alignment) * alignment
+    tensors = {}
+    for name, entry in header["tensors"].items():
+        dtype = np.dtype(entry["dtype"])
+        start = data_start + entry["offset"]
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        tensors[name] = torch.from_numpy(raw[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"]))
+    return tensors
+
+def loadFlatWeights(model: nn.Module, path: str, *, inference_only: bool = False):
+    """Load a saveFlatWeights file into `model` by copying the weights into its existing parameters and buffers.
+    With `inference_only` on the CPU the mapped tensors become the parameters themselves (load_state_dict(assign=True))
+    and nothing is read until it is used. Only do that for a model that will not be trained: an optimizer, or
+    DQNAgent.online_parameters, would keep the replaced tensors and never update the model again."""
+    tensors = mapFlatWeights(path)
+    on_cpu = all(tensor.device.type == "cpu" for tensor in model.state_dict().values())
+    model.load_state_dict(tensors, assign=inference_only and on_cpu)
+    return model
+
+def quantizeForInference(model: nn.Module):
+    """Int8 CPU copy of a Q-network for acting. Noisy layers (anything with weight_mu, so URtesting's too) are frozen
+    to their mu weights as plain Linears, then every Linear is dynamically quantized: int8 weights, activations
+    quantized per batch at run time, so no calibration pass is needed. The copy is in eval mode and has no noise."""
+    model = copy.deepcopy(model).cpu().eval()
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if hasattr(child, "weight_mu"):
+                linear = nn.Linear(child.in_features, child.out_features)
+                linear.weight.data.copy_(child.weight_mu.data)
+                linear.bias.data.copy_(child.bias_mu.data)
+                setattr(parent, name, linear)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def compilePolicy(model: nn.Module, path: str, *, num_states: int = 2_000_000, num_games: int = 4096,
+                  epsilon: float = 0.25, max_steps: int = 50_000_000, batch_size: int = 65_536):
+    """Evaluate `model` once over the states its policy reaches and write them as a PolicyTable to `path`.
+
+    Every hp, shell and inventory combination is far too many states to enumerate, so they are collected from VecGame
+    play with the model's own greedy actions, replaced by a uniformly random action with probability `epsilon` so the
+    neighbourhood of its games is covered too, until `num_states` distinct packed states or `max_steps` env steps.
+    They are then run through the eval-mode model (NoisyLinear uses its mu weights) in batches of `batch_size`.
+    Returns the number of states written."""
+    training = model.training
+    model.eval()
+    game = VecGame(num_games)
+    rng = np.random.default_rng()
+    states = game.getState()
+    seen = np.zeros(0, dtype=np.int64)
+    fresh = [packStates(states)]
+    steps = 0
+    while len(seen) < num_states and steps < max_steps:
+        with torch.no_grad():
+            actions = model(torch.as_tensor(states, dtype=torch.float32, device=device)).argmax(dim=1).cpu().numpy()
+        explore = rng.random(num_games) < epsilon
+        actions[explore] = rng.integers(0, 8, int(explore.sum()))
+        states, _, _ = game.step(actions)
+        fresh.append(packStates(states))
+        steps += num_games
+        if len(fresh) == 64:
+            seen = np.unique(np.concatenate([seen] + fresh))
+            fresh = []
+    keys = np.unique(np.concatenate([seen] + fresh))
+    keys = keys[keys >= 0]
+
+    q_values = np.zeros((len(keys), 8), dtype=np.float32)
+    with torch.no_grad():
+        for start in range(0, len(keys), batch_size):
+            states = torch.as_tensor(unpackStates(keys[start:start + batch_size]), device=device)
+            q_values[start:start + batch_size] = model(states).cpu().numpy()
+    model.train(training)
+    writePolicyTable(path, keys, q_values)
+    print(f"Compiled {len(keys)} states from {steps} env steps to {path}")
+    return len(keys)
+
+def evaluatePolicy(policy, num_games: int = 10_000, parallel: int = 1024, *, max_turns: int = 200, masked: bool = False, seed=None):
+    """Greedy win rate and mean reward per game of `policy` (DQNAgent, NumpyPolicy or PolicyTable) over `num_games`
+    VecGame games, with `parallel` of them played at a time. Greedy play is deterministic, so a policy that keeps
+    picking an item it does not hold never finishes; games are cut off after `max_turns` actions and count as losses.
+    `masked` passes the legal-action masks to a DQNAgent."""
+    game = VecGame(parallel, seed=seed)
+    states = game.getState()
+    returns = np.zeros(parallel, dtype=np.float32)
+    turns = np.zeros(parallel, dtype=np.int64)
+    finished, wins, stuck, total_reward = 0, 0, 0, 0.0
+    while finished < num_games:
+        actions = policy.actBatch(states, "greedy", masks=game.legalActions()) if masked else policy.actBatch(states, "greedy")
+        if isinstance(actions, torch.Tensor):
+            actions = actions.cpu().numpy()
+        states, rewards, dones = game.step(actions)
+        returns += rewards
+        turns += 1
+        cut_off = ~dones & (turns >= max_turns)
+        if cut_off.any():
+            game.resetGame(cut_off)
+            states = game.getState()
+            stuck += int(cut_off.sum())
+        ended = dones | cut_off
+        finished += int(ended.sum())
+        wins += int((dones & (rewards > 0)).sum())  # +25 for the DEALER's death, -30 for the AI's
+        total_reward += float(returns[ended].sum())
+        returns[ended], turns[ended] = 0, 0
+    print(f"{finished} games: win rate {wins / finished * 100:.2f}%, mean reward per game {total_reward / finished:.3f}, {stuck} cut off")
+    return wins / finished
+
+class ReplayBuffer():
+    def __init__(self, capacity: int, state_size: int, *, compact: bool = False, device=device):
+        """Fixed-capacity ring buffer of transitions held in preallocated tensors.
+        
+        Inserts overwrite the oldest transition in O(1) and sample() draws all indices in one call,
+        so batches come out already stacked on `device` with no per-transition Python work.
+        With compact=True every state field is stored as its 4-bit StateEncoding code (two per byte), actions as int8,
+        rewards as float16 and dones as bool: 29 bytes per transition instead of 209.
+        Codes are decoded back to the getState layout in one vectorized step at sample time. pack() raises on a field
+        outside its StateEncoding range rather than storing a wrong code; that check is on when the buffer lives on the CPU
+        (`check_codes`), since elsewhere it costs a host sync per add.
+        The legal-action mask of each next state (Game.legalActions) is kept as one byte of bits; it cannot be derived
+        from next_state because DEALER_did_play is not part of the state vector."""
+        self.capacity = capacity
+        self.state_size = state_size
+        self.compact = compact
+        self.device = device
+        if compact:
+            self.scale = torch.as_tensor(stateScale(state_size), device=device)
+            self.offset = torch.as_tensor(stateOffset(state_size), dtype=torch.float32, device=device)
+            self.limits = torch.as_tensor(stateLimits(state_size), dtype=torch.float32, device=device)
+            self.check_codes = torch.device(device).type == "cpu"
+            state_shape, dtypes = (capacity, state_size // 2), (torch.uint8, torch.int8, torch.float16, torch.bool)
+        else:
+            state_shape, dtypes = (capacity, state_size), (torch.float32, torch.int64, torch.float32, torch.float32)
+        self.states = self._allocate("states", state_shape, dtypes[0])
+        self.actions = self._allocate("actions", (capacity,), dtypes[1])
+        self.rewards = self._allocate("rewards", (capacity,), dtypes[2])
+        self.next_states = self._allocate("next_states", state_shape, dtypes[0])
+        self.dones = self._allocate("dones", (capacity,), dtypes[3])
+        self.next_masks = self._allocate("next_masks", (capacity,), torch.uint8)
+        self.bits = 1 << torch.arange(8, device=device)
+        self.position = 0
+        self.size = 0
+
+    def _allocate(self, name, shape, dtype):
+        return torch.zeros(shape, dtype=dtype, device=self.device)
+
+    def __len__(self):
+        return self.size
+
+    def fields(self):
+        return (self.states, self.actions, self.rewards, self.next_states, self.dones, self.next_masks)
+
+    def pack(self, states):
+        """Encode (..., state_size) states as (..., state_size // 2) bytes of two 4-bit field codes."""
+        codes = (torch.as_tensor(states, device=self.device).float() * self.scale).round_().add_(self.offset)
+        if self.check_codes:
+            invalid = ((codes < 0) | (codes >= self.limits)).any(-1)
+            if invalid.any():
+                row = codes.reshape(-1, self.state_size)[invalid.reshape(-1)][0]
+                raise ValueError(f"State outside the encodable range, codes {row.long().tolist()} (limits {self.limits.long().tolist()})")
+        codes = codes.to(torch.uint8)
+        return codes[..., 0::2] | (codes[..., 1::2] << 4)
+
+    def unpack(self, packed):
+        """Decode pack()ed bytes back to float32 states in the getState layout."""
+        codes = torch.stack((packed & 15, packed >> 4), dim=-1).flatten(-2)
+        return (codes - self.offset) / self.scale
+
+    def packMasks(self, masks):
+        """(..., 8) boolean action masks as (...) bytes of bits; None means every action is legal."""
+        if masks is None:
+            return torch.tensor(255, dtype=torch.uint8)
+        return (torch.as_tensor(masks, device=self.device).long() * self.bits).sum(-1).to(torch.uint8)
+
+    def unpackMasks(self, packed):
+        return (packed.long().unsqueeze(-1) & self.bits) > 0
+
+    def add(self, state, action, reward, next_state, done, next_mask=None):
+        """Store one transition, overwriting the oldest once the buffer is full."""
+        i = self.position
+        if self.compact:
+            state, next_state = self.pack(state), self.pack(next_state)
+        for field, value in zip(self.fields(), (state, action, reward, next_state, done, self.packMasks(next_mask))):
+            field[i] = torch.as_tensor(value)
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def addBatch(self, states, actions, rewards, next_states, dones, next_masks=None):
+        """Store a batch of transitions (NumPy arrays or tensors on any device) with at most two slice copies per field."""
+        if self.compact:
+            states, next_states = self.pack(states), self.pack(next_states)
+        next_masks = self.packMasks(next_masks).expand(len(states))
+        batch = [torch.as_tensor(value)[-self.capacity:] for value in (states, actions, rewards, next_states, dones, next_masks)]
+        n = len(batch[0])
+        first = min(n, self.capacity - self.position)
+        for field, value in zip(self.fields(), batch):
+            field[self.position:self.position + first] = value[:first]
+            field[:n - first] = value[first:]
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size: int):
+        """Draw `batch_size` transitions uniformly (with replacement).
+        Returns (states, actions, rewards, next_states, dones, next_masks) on `device`, actions shaped (batch_size, 1)."""
+        indices = torch.randint(0, self.size, (batch_size,), device=self.states.device)
+        return self._gather(indices)
+
+    def _gather(self, indices):
+        states, actions, rewards, next_states, dones, next_masks = (field[indices].to(self.device) for field in self.fields())
+        if self.compact:
+            states, next_states = self.unpack(states), self.unpack(next_states)
+            actions, rewards, dones = actions.long(), rewards.float(), dones.float()
+        return states, actions.unsqueeze(1), rewards, next_states, dones, self.unpackMasks(next_masks)
+
+    def nbytes(self):
+        """Memory held by the buffer's storage, in bytes."""
+        return sum(field.nelement() * field.element_size() for field in self.fields())
+
+    def flush(self):
+        """Persist the buffer; in-memory storage has nothing to write."""
+        pass
+
+    def snapshot(self):
+        """Copy of the stored transitions and ring position for a checkpoint (see Checkpointer)."""
+        return {"position": self.position, "size": self.size,
+                "fields": [field[:self.size].clone().cpu() for field in self.fields()]}
+
+    def restore(self, snapshot: dict):
+        if len(snapshot["fields"][0]) > self.capacity:
+            raise ValueError(f"Checkpointed replay holds {len(snapshot['fields'][0])} transitions, capacity is {self.capacity}")
+        for field, value in zip(self.fields(), snapshot["fields"]):
+            field[:len(value)] = value
+        self.position, self.size = snapshot["position"], snapshot["size"]
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    def __init__(self, capacity: int, state_size: int, *, directory: str = "replay", compact: bool = False, device=device):
+        """ReplayBuffer whose storage lives in memory-mapped .npy files under `directory`.
+        
+        Resident memory is bounded by the OS page cache rather than by capacity: sampled rows are paged in on demand and
+        copied to `device`. flush() records the ring position in meta.json, and constructing a buffer over the same
+        directory with the same capacity, state_size and encoding resumes from the stored transitions."""
+        self.directory = directory
+        self.arrays = {}
+        os.makedirs(directory, exist_ok=True)
+        meta = self._readMeta()
+        if meta is not None and (meta["capacity"], meta["state_size"], meta["compact"]) != (capacity, state_size, compact):
+            raise ValueError(f"Replay in {directory} was built with capacity {meta['capacity']}, state_size {meta['state_size']} "
+                             f"and compact={meta['compact']}, not {capacity}, {state_size} and compact={compact}; "
+                             f"delete it or choose another directory")
+        self.resume = meta is not None
+        super().__init__(capacity, state_size, compact=compact, device=device)
+        if self.resume:
+            self.position, self.size = meta["position"], meta["size"]
+            print(f"Resuming replay from {directory} with {self.size} transitions")
+
+    def _readMeta(self):
+        path = os.path.join(self.directory, "meta.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _allocate(self, name, shape, dtype):
+        path = os.path.join(self.directory, f"{name}.npy")
+        if self.resume and name == "next_masks" and not os.path.exists(path):
+            # replay written before masks were stored: treat every action as legal
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+            array[:] = 255
+        elif self.resume:
+            array = np.lib.format.open_memmap(path, mode="r+")
+        else:
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=torch.empty(0, dtype=dtype).numpy().dtype, shape=shape)
+        self.arrays[name] = array
+        return torch.from_numpy(array)
+
+    def flush(self):
+        """Write dirty pages and then the ring position, so a crash never leaves meta.json ahead of the data."""
+        for array in self.arrays.values():
+            array.flush()
+        path = os.path.join(self.directory, "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"capacity": self.capacity, "state_size": self.state_size, "compact": self.compact,
+                       "position": self.position, "size": self.size}, f)
+        os.replace(path + ".tmp", path)
+
+    def snapshot(self):
+        """The transitions already live on disk, so a checkpoint only records the ring position after flushing.
+        Restoring it rewinds position and size, but slots written after the checkpoint keep their newer data."""
+        self.flush()
+        return {"position": self.position, "size": self.size, "directory": self.directory}
+
+    def restore(self, snapshot: dict):
+        self.position, self.size = snapshot["position"], snapshot["size"]
+
+
+class SumTree():
+    def __init__(self, capacity: int):
+        """Array-backed binary sum-tree over `capacity` priorities.
+        
+        Node 1 is the root and the children of node i are 2i and 2i+1; leaves start at `self.leaves` (capacity rounded
+        up to a power of two) so every leaf sits at the same depth and a batch of lookups descends level by level in lockstep."""
+        self.leaves = 1 << max(capacity - 1, 1).bit_length()
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, priorities):
+        """Set the priorities of leaves `indices` and recompute their ancestors, one tree level per pass."""
+        nodes = np.asarray(indices, dtype=np.int64) + self.leaves
+        self.tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] > 0:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """Leaf index whose prefix-sum interval contains each of `values` (each in [0, total))."""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.leaves:
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values -= go_right * self.tree[left]
+            nodes = left + go_right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(self, capacity: int, state_size: int, *, alpha=0.6, beta=0.4, beta_steps=100_000, epsilon=1e-3,
+                 compact: bool = False, device=device):
+        """ReplayBuffer that samples transition i with probability p_i^alpha / sum(p^alpha).
+        
+        New transitions get the current max priority so they are seen at least once; sample() also returns
+        importance-sampling weights (beta annealed to 1 over `beta_steps` samples) and the indices to pass back to updatePriorities()."""
+        super().__init__(capacity, state_size, compact=compact, device=device)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.sampled = 0
+
+    def add(self, state, action, reward, next_state, done, next_mask=None):
+        self.tree.update([self.position], self.max_priority)
+        super().add(state, action, reward, next_state, done, next_mask)
+
+    def addBatch(self, states, actions, rewards, next_states, dones, next_masks=None):
+        n = min(len(states), self.capacity)
+        self.tree.update((self.position + np.arange(n)) % self.capacity, self.max_priority)
+        super().addBatch(states, actions, rewards, next_states, dones, next_masks)
+
+    def sample(self, batch_size: int):
+        """Stratified proportional sampling: one draw from each of `batch_size` equal slices of the total priority.
+        Returns (states, actions, rewards, next_states, dones, next_masks, weights, indices)."""
+        total = self.tree.total()
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * (total / batch_size)
+        indices = np.minimum(self.tree.find(values), self.size - 1)
+
+        self.sampled += 1
+        self.beta = min(1.0, self.beta_start + (1.0 - self.beta_start) * self.sampled / self.beta_steps)
+        probabilities = self.tree.tree[indices + self.tree.leaves] / total
+        weights = (self.size * probabilities) ** -self.beta
+        weights /= weights.max()
+
+        batch = self._gather(torch.from_numpy(indices).to(self.states.device))
+        return (*batch, torch.as_tensor(weights, dtype=torch.float32, device=self.device), indices)
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot.update(tree=self.tree.tree.copy(), max_priority=self.max_priority, sampled=self.sampled, beta=self.beta)
+        return snapshot
+
+    def restore(self, snapshot: dict):
+        super().restore(snapshot)
+        self.tree.tree[:] = snapshot["tree"]
+        self.max_priority, self.sampled, self.beta = snapshot["max_priority"], snapshot["sampled"], snapshot["beta"]
+
+    def updatePriorities(self, indices, td_errors):
+        """Set priorities from the absolute TD errors of a sampled batch."""
+        priorities = (np.abs(td_errors) + self.epsilon) ** self.alpha
+        self.tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+
+class BatchPrefetcher():
+    def __init__(self, memory: ReplayBuffer, batch_size: int, depth: int = 2):
+        """Samples minibatches from `memory` on a background thread into a queue of up to `depth` ready batches,
+        so the learner only pops one and runs forward/backward.
+
+        Writers must hold `lock` while adding to memory (DQNAgent.remember does) so a batch never mixes fields of a
+        transition being overwritten. Batches are at most `depth` inserts stale, and with prioritized replay their
+        priorities are up to `depth` updates old. `stall_time` is the total time the learner waited for a batch."""
+        self.memory = memory
+        self.batch_size = batch_size
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.batches = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.stall_time = 0.0
+        self.popped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if len(self.memory) < self.batch_size:
+                time.sleep(0.001)
+                continue
+            with self.lock:
+                batch = self.memory.sample(self.batch_size)
+            while not self.stop_event.is_set():
+                try:
+                    self.batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """The next ready batch, waiting (and counting the wait as stall time) if the queue is empty."""
+        start_time = time.perf_counter()
+        batch = self.batches.get()
+        self.stall_time += time.perf_counter() - start_time
+        self.popped += 1
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def writeCheckpoint(state: dict, path: str):
+    """torch.save to a temporary file renamed over `path`, so a reader never sees a half-written checkpoint."""
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def listCheckpoints(directory: str, name: str):
+    """(steps, path) of every `name`_<steps>.pth checkpoint in `directory`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    pattern = re.compile(re.escape(name) + r"_(\d+)\.pth$")
+    found = ((pattern.match(filename), filename) for filename in os.listdir(directory))
+    return sorted((int(match.group(1)), os.path.join(directory, filename)) for match, filename in found if match)
+
+
+class Checkpointer():
+    def __init__(self, agent, directory: str = os.path.join("models", "checkpoints"), *, every_steps: int = None,
+                 every_seconds: float = None, keep: int = 3, include_replay: bool = False):
+        """Periodic checkpoints of `agent` (DQNAgent.checkpointState) written by a background thread.
+
+        maybeSave(), called from the training loop, takes a snapshot once `every_steps` gradient steps or `every_seconds`
+        have passed since the last one; copying the tensors is all the training thread does. The writer renames each file
+        into place (writeCheckpoint) and then deletes all but the newest `keep`. A snapshot due while the previous one is
+        still being written is skipped and retried on the next call, so training never waits on the disk. A write that
+        fails (a full disk, a removed directory) is printed and counted in `failed`, and the next snapshot is tried as usual."""
+        if keep < 1:
+            raise ValueError(f"Checkpointer must keep at least one checkpoint, not {keep}")
+        self.agent = agent
+        self.directory = directory
+        self.every_steps, self.every_seconds = every_steps, every_seconds
+        self.keep = keep
+        self.include_replay = include_replay
+        os.makedirs(directory, exist_ok=True)
+        self.last_steps, self.last_time = agent.steps, time.time()
+        self.pending = queue.Queue(maxsize=1)
+        self.write_time = 0.0
+        self.written = self.failed = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            state, path = item
+            start_time = time.time()
+            try:
+                writeCheckpoint(state, path)
+                self.written += 1
+                for _, old_path in listCheckpoints(self.directory, self.agent.name)[:-self.keep]:
+                    os.remove(old_path)
+            except Exception as error:
+                self.failed += 1
+                print(f"Checkpoint {path} failed: {type(error).__name__}: {error}")
+            finally:
+                self.write_time += time.time() - start_time
+                self.pending.task_done()
+
+    def latest(self):
+        """Path of the newest checkpoint in the directory, None if there is none."""
+        checkpoints = listCheckpoints(self.directory, self.agent.name)
+        return checkpoints[-1][1] if checkpoints else None
+
+    def maybeSave(self):
+        due = ((self.every_steps is not None and self.agent.steps - self.last_steps >= self.every_steps)
+               or (self.every_seconds is not None and time.time() - self.last_time >= self.every_seconds))
+        return self.save() if due else False
+
+    def save(self):
+        """Queue a snapshot for writing; returns False without taking one if the writer is still busy."""
+        if self.pending.unfinished_tasks:
+            return False
+        path = os.path.join(self.directory, f"{self.agent.name}_{self.agent.steps}.pth")
+        self.pending.put((self.agent.checkpointState(self.include_replay), path))
+        self.last_steps, self.last_time = self.agent.steps, time.time()
+        return True
+
+    def close(self):
+        """Wait for the checkpoint being written, then stop the writer."""
+        self.pending.join()
+        self.pending.put(None)
+        self.thread.join()
+
+
+class QCache():
+    def __init__(self, capacity: int):
+        """Bounded LRU memo of Q-values keyed on packStates(state), for acting with a deterministic (eval-mode) model.
+
+        Entries belong to one model version; a lookup with any other version empties the cache first, so a weight update
+        (DQNAgent bumps model_version in learn, loadModel and useQuantizedPolicy) invalidates everything at once."""
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def qValues(self, states, forward, version):
+        """Q-values of a (N, inputs) NumPy batch: cached rows are reused, the rest go through `forward` in one batch and are stored."""
+        if version != self.version:
+            self.invalidations += self.version is not None and len(self.entries) > 0
+            self.entries.clear()
+            self.version = version
+        keys = packStates(states).tolist()
+        rows, missing = [None] * len(keys), []
+        for i, key in enumerate(keys):
+            q_values = self.entries.get(key)
+            if q_values is None:
+                missing.append(i)
+            else:
+                self.entries.move_to_end(key)
+                rows[i] = q_values
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            computed = forward(states[missing])
+            for i, q_values in zip(missing, computed):
+                rows[i] = q_values = q_values.clone()  # a view would keep the whole batch alive
+                if keys[i] >= 0:
+                    self.entries[keys[i]] = q_values
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return torch.stack(rows)
+
+    def hitRate(self):
+        return self.hits / max(self.hits + self.misses, 1)
 
 class DQNAgent:
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, *, prioritized=False, replay_dir=None, replay_capacity=100_000, compact_replay=True,
+                 q_cache_size=0, target_tau=None, prefetch_depth=0):
+        """q_cache_size: keep the Q-values of up to this many states in a QCache while acting with an eval-mode model.
+        target_tau: blend the target network towards the online one by this fraction after every gradient step
+        (Polyak averaging) instead of copying it whenever updateTargetNetwork is called.
+        prefetch_depth: sample minibatches ahead on a BatchPrefetcher thread, keeping up to this many ready."""
         self.name = "DQNAgent_v1b.1.2"
         self.inputs = inputs
         self.outputs = outputs
         self.gamma = 0.92
         self.alpha = 1
         self.batch_size = 128
-        self.memory = deque(maxlen=100_000)
+        self.prioritized = prioritized
+        if prioritized and replay_dir is not None:
+            raise ValueError("Prioritized replay is held in memory and cannot use replay_dir")
+        if prioritized:
+            self.memory = PrioritizedReplayBuffer(replay_capacity, inputs, compact=compact_replay)
+        elif replay_dir is not None:
+            self.memory = MemmapReplayBuffer(replay_capacity, inputs, directory=replay_dir, compact=compact_replay)
+        else:
+            self.memory = ReplayBuffer(replay_capacity, inputs, compact=compact_replay)
         self.model = SCDDDQN(inputs, outputs, [128, 128, 128]).to(device)
         self.target_model = SCDDDQN(inputs, outputs, [128, 128, 128]).to(device)
         self.optimizer = optim.Adam(self.model.parameters(), lr=0.00006)
         self.loss_fn = nn.MSELoss().to(device)
         self.steps = 0
-        self.updateTargetNetwork()
+        self.env_steps = 0
+        self.last_report = (time.time(), 0, 0)
+        self.policy_model, self.policy_device = self.model, device
+        self.model_version = 0
+        self.q_cache = QCache(q_cache_size) if q_cache_size > 0 else None
+        self.target_tau = target_tau
+        self.online_parameters, self.target_parameters = list(self.model.parameters()), list(self.target_model.parameters())
+        self.target_model.load_state_dict(self.model.state_dict())
+        self.prefetcher = BatchPrefetcher(self.memory, self.batch_size, prefetch_depth) if prefetch_depth > 0 else None
+        self.memory_lock = self.prefetcher.lock if self.prefetcher is not None else nullcontext()
 
     def updateTargetNetwork(self):
-        """Copy weights from the online model to the target model."""
-        self.target_model.load_state_dict(self.model.state_dict())
+        """Copy weights from the online model to the target model; with target_tau learn() already blends them every step."""
+        if self.target_tau is None:
+            self.target_model.load_state_dict(self.model.state_dict())
+
+    def softUpdateTargetNetwork(self):
+        """target = tau * online + (1 - tau) * target over all parameters, as two fused multi-tensor ops."""
+        with torch.no_grad():
+            torch._foreach_mul_(self.target_parameters, 1 - self.target_tau)
+            torch._foreach_add_(self.target_parameters, self.online_parameters, alpha=self.target_tau)
+
+    def useQuantizedPolicy(self):
+        """Act with an int8 snapshot of the current model (quantizeForInference); call again to refresh it after training."""
+        self.policy_model, self.policy_device = quantizeForInference(self.model), torch.device("cpu")
+        self.model_version += 1
 
-    def act(self, state):
-        """Sample actions using a stochastic softmax policy."""
-        if len(state.shape) == 1:
-            state = state.reshape(1, -1)
-        state = torch.FloatTensor(state).to(device)
+    def act(self, state, mode: str = "softmax", epsilon: float = 0.05, mask=None):
+        """Sample an action for one state using a stochastic softmax policy (see actBatch for the other modes)."""
+        return self.actBatch(state.reshape(1, -1), mode, epsilon, None if mask is None else mask.reshape(1, -1))[0].item()
+
+    def actBatch(self, states, mode: str = "softmax", epsilon: float = 0.05, masks=None):
+        """Pick one action per row of an (N, inputs) array or tensor with a single forward pass; returns N actions on `device`.
+        "softmax" samples from softmax(Q / alpha), "greedy" takes argmax Q,
+        "epsilon" takes argmax Q but a uniformly random action with probability `epsilon`.
+        `masks` (N, 8 booleans from legalActions) restricts every mode to the legal actions.
+        With a QCache and an eval-mode policy model (no noise, so Q only changes with the weights) repeated states skip the forward."""
+        if self.q_cache is not None and not self.policy_model.training:
+            states = states.cpu().numpy() if isinstance(states, torch.Tensor) else np.asarray(states, dtype=np.float32)
+            q_values = self.q_cache.qValues(states, self.policyQValues, self.model_version).to(device)
+        else:
+            q_values = self.policyQValues(states).to(device)
+        if masks is not None:
+            masks = torch.as_tensor(masks, dtype=torch.bool, device=device)
+            q_values = q_values.masked_fill(~masks, float("-inf"))
+        if mode == "softmax":
+            return torch.multinomial(torch.softmax(q_values / self.alpha, dim=1), 1).squeeze(1)
+        greedy = q_values.argmax(dim=1)
+        if mode == "greedy":
+            return greedy
+        if mode == "epsilon":
+            explore = torch.rand(len(greedy), device=device) < epsilon
+            random_actions = torch.randint_like(greedy, self.outputs) if masks is None else torch.multinomial(masks.float(), 1).squeeze(1)
+            return torch.where(explore, random_actions, greedy)
+        raise ValueError(f"Unknown action selection mode: {mode}")
 
+    def policyQValues(self, states):
         with torch.no_grad():
-            q_values = self.model(state).squeeze()
-            probabilities = torch.softmax(q_values / self.alpha, dim=0)
-        return torch.multinomial(probabilities, 1).item()
+            return self.policy_model(torch.as_tensor(states, dtype=torch.float32, device=self.policy_device))
 
-    def remember(self, state, action, reward, next_state, done):
-        """Store experiences in memory."""
-        experience = (state, action, reward, next_state, done)
-        self.memory.append(experience)
+    def remember(self, state, action, reward, next_state, done, next_mask=None):
+        """Store experiences in memory; `next_mask` is legalActions() at next_state, None if every action counts."""
+        with self.memory_lock:
+            self.memory.add(state, action, reward, next_state, done, next_mask)
 
-    def replay(self):
-        """Perform a training step on a sampled batch."""
+    def rememberBatch(self, states, actions, rewards, next_states, dones, next_masks=None):
+        """Store a batch of experiences from a VecGame or TorchVecGame."""
+        with self.memory_lock:
+            self.memory.addBatch(states, actions, rewards, next_states, dones, next_masks)
+
+    def replay(self, gradient_steps: int = 1):
+        """Perform `gradient_steps` training steps; one uniform sample of gradient_steps * batch_size transitions is drawn
+        and split into minibatches, or with a prefetcher `gradient_steps` ready minibatches are popped.
+        Prioritized replay samples every minibatch on its own: a split stratified sample would give each minibatch one
+        band of the priority mass, and its weights and beta schedule are per minibatch."""
         if len(self.memory) < self.batch_size:
             return
 
-        batch = random.sample(self.memory, self.batch_size)
-        states, actions, rewards, next_states, dones = zip(*batch)
-
-        states = torch.FloatTensor(np.array(states)).to(device)
-        actions = torch.LongTensor(actions).unsqueeze(1).to(device)
-        rewards = torch.FloatTensor(rewards).to(device)
-        next_states = torch.FloatTensor(np.array(next_states)).to(device)
-        dones = torch.FloatTensor(dones).to(device)
+        if self.prefetcher is not None:
+            for _ in range(gradient_steps):
+                self.learn(*self.prefetcher.get())
+            return
+        if self.prioritized:
+            for _ in range(gradient_steps):
+                self.learn(*self.memory.sample(self.batch_size))
+            return
+        batch = self.memory.sample(self.batch_size * gradient_steps)
+        for i in range(gradient_steps):
+            self.learn(*(field[i * self.batch_size:(i + 1) * self.batch_size] for field in batch))
 
+    def learn(self, states, actions, rewards, next_states, dones, next_masks, weights=None, indices=None):
+        """One gradient step on a minibatch; `weights` and `indices` come from prioritized replay.
+        The soft value of a next state only sums over its legal actions (shooting always is, so it is never empty)."""
+        self.model.reset_noise()
+        self.target_model.reset_noise()
         # Normalize rewards for stability
         #rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-5)
 
         with torch.no_grad():
-            next_q_values = self.target_model(next_states)
+            next_q_values = self.target_model(next_states).masked_fill(~next_masks, float("-inf"))
             next_soft_q_values = self.alpha * torch.logsumexp(next_q_values / self.alpha, dim=1)
             target_q_values = rewards + (1 - dones) * self.gamma * next_soft_q_values
 
         current_q_values = self.model(states).gather(1, actions).squeeze()
-        loss = self.loss_fn(current_q_values, target_q_values)
+        if self.prioritized:
+            td_errors = target_q_values - current_q_values
+            loss = (weights * td_errors ** 2).mean()
+            with self.memory_lock:
+                self.memory.updatePriorities(indices, td_errors.detach().cpu().numpy())
+        else:
+            loss = self.loss_fn(current_q_values, target_q_values)
 
         self.optimizer.zero_grad()
         loss.backward()
         torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
         self.optimizer.step()
+        if self.target_tau is not None:
+            self.softUpdateTargetNetwork()
         self.steps += 1
+        self.model_version += 1
+
+    def throughput(self):
+        """Environment steps and gradient steps per second since the previous call."""
+        now = time.time()
+        last_time, last_env_steps, last_steps = self.last_report
+        elapsed = max(now - last_time, 1e-9)
+        self.last_report = (now, self.env_steps, self.steps)
+        return (self.env_steps - last_env_steps) / elapsed, (self.steps - last_steps) / elapsed
+
+    def checkpointState(self, include_replay: bool = False):
+        """Everything needed to resume training where it stopped: both networks, the optimizer, the step counters, the
+        Python/NumPy/torch RNG states and optionally the replay memory, copied so training can go on while it is written."""
+        state = {
+            'model_state_dict': copy.deepcopy(self.model.state_dict()),
+            'target_model_state_dict': copy.deepcopy(self.target_model.state_dict()),
+            'optimizer_state_dict': copy.deepcopy(self.optimizer.state_dict()),
+            'steps': self.steps,
+            'env_steps': self.env_steps,
+            'rng_state': {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+                          'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None},
+        }
+        if include_replay:
+            with self.memory_lock:
+                state['replay'] = self.memory.snapshot()
+        return state
 
     def saveModel(self):
         filename = f"{self.name}_{self.steps}.pth"
@@ -536,28 +1772,42 @@ class DQNAgent:
             os.makedirs("models")
             
         model_path = os.path.join("models", filename)
-        torch.save({
-            'model_state_dict': self.model.state_dict(),
-            'optimizer_state_dict': self.optimizer.state_dict(),
-            'steps': self.steps,
-        }, model_path)
+        writeCheckpoint(self.checkpointState(), model_path)
+        self.memory.flush()
 
-    def loadModel(self):
-        filename = f"DQNAgent_v1a.5.3_17007.pth"
-        if not os.path.exists("models"):
-            os.makedirs("models")
-            
-        model_path = os.path.join("models", filename)
-        if os.path.exists(model_path):
-            checkpoint = torch.load(model_path)
-            self.model.load_state_dict(checkpoint['model_state_dict'])
-            self.target_model.load_state_dict(checkpoint['model_state_dict'])
-            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-            self.steps = checkpoint['steps']
-        else:
+    def loadModel(self, model_path: str = None):
+        """Restore a checkpoint from saveModel or a Checkpointer, by default the newest of this agent's in models/.
+        Checkpoints without a target network, RNG or replay state (older saveModel files) restore what they have."""
+        if model_path is None:
+            checkpoints = listCheckpoints("models", self.name)
+            if not checkpoints:
+                raise Exception(f"No {self.name} checkpoint found in models")
+            model_path = checkpoints[-1][1]
+        if not os.path.exists(model_path):
             raise Exception(f"Model not found in {model_path}")
+
+        checkpoint = torch.load(model_path, map_location="cpu", weights_only=False)
+        self.model.load_state_dict(checkpoint['model_state_dict'])
+        self.target_model.load_state_dict(checkpoint.get('target_model_state_dict', checkpoint['model_state_dict']))
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        self.steps = checkpoint['steps']
+        self.env_steps = checkpoint.get('env_steps', self.env_steps)
+        if 'rng_state' in checkpoint:
+            rng_state = checkpoint['rng_state']
+            random.setstate(rng_state['python'])
+            np.random.set_state(rng_state['numpy'])
+            torch.set_rng_state(rng_state['torch'])
+            if rng_state['cuda'] is not None and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all(rng_state['cuda'])
+        if 'replay' in checkpoint:
+            with self.memory_lock:
+                self.memory.restore(checkpoint['replay'])
+        self.model_version += 1
+        print(f"Loaded {model_path} at step {self.steps}")
     
-def playGame(agent: DQNAgent, game: Game):
+def playGame(agent: DQNAgent, game: Game, *, train_every: int = 1, gradient_steps: int = 1, mask_actions: bool = True):
+    """Play one game, training every `train_every` agent actions with `gradient_steps` gradient steps each time.
+    With `mask_actions` the agent only picks legal actions (Game.legalActions) and its targets only count legal ones."""
     game.resetGame()
     state = game.getState()
     done = turn_done = False
@@ -568,7 +1818,7 @@ def playGame(agent: DQNAgent, game: Game):
             turn_done = False
             while not turn_done:
                 #game.debugPrintGame()
-                action = agent.act(state)
+                action = agent.act(state, mask=game.legalActions() if mask_actions else None)
                 #print(f"\nAI Action: {action}")
                 
                 match action:
@@ -597,6 +1847,7 @@ def playGame(agent: DQNAgent, game: Game):
                     case 7:
                         #print("AI shoots self")
                         reward = game.AIshootAI()
+                        turn_done = True
                     case _:
                         raise Exception(f"Invalid action: {action}")
                     
@@ -615,15 +1866,19 @@ def playGame(agent: DQNAgent, game: Game):
                     #print("DEALER died!")
                         
                 next_state = game.getState()
-                agent.remember(state, action, reward, next_state, done)
+                agent.remember(state, action, reward, next_state, done, game.legalActions() if mask_actions else None)
                 state = next_state
-                agent.replay()
+                agent.env_steps += 1
                 #print(reward)
                 rewards.append(reward)
-                if (agent.steps + 1) % 200 == 0:
-                    agent.updateTargetNetwork()
-                    avg_reward = sum(rewards) / len(rewards) if rewards else 0
-                    print(f"{avg_reward:.4f}")
+                if agent.env_steps % train_every == 0:
+                    steps = agent.steps
+                    agent.replay(gradient_steps)
+                    if (agent.steps + 1) // 200 > (steps + 1) // 200:
+                        agent.updateTargetNetwork()
+                        avg_reward = sum(rewards) / len(rewards) if rewards else 0
+                        env_sps, grad_sps = agent.throughput()
+                        print(f"{avg_reward:.4f} | env steps/s: {env_sps:.0f} | grad steps/s: {grad_sps:.0f}")
                     
             game.shell = 0 
             game.is_sawed = False
@@ -645,18 +1900,44 @@ def playGame(agent: DQNAgent, game: Game):
             game.DEALER_can_play = True
             #print("DEALER turn skipped (cuffed)")
 
+def playTorchGames(agent: DQNAgent, game: TorchVecGame, iterations: int = 1_000_000, *, train_every: int = 1, gradient_steps: int = 1,
+                   mask_actions: bool = True):
+    """playGame for a TorchVecGame: acts, steps and remembers all of its games at once without leaving torch.
+    Trains after every `train_every` calls to game.step (each one is num_games env steps)."""
+    state = game.getState()
+    mask = game.legalActions() if mask_actions else None
+    rewards = deque(maxlen=200)
+    i = calls = 0
+    while i < iterations:
+        action = agent.actBatch(state, masks=mask)
+        next_state, reward, done = game.step(action)
+        mask = game.legalActions() if mask_actions else None
+        agent.rememberBatch(state, action, reward, next_state, done, mask)
+        state = next_state
+        rewards.append(reward.mean())
+        i += game.num_games
+        agent.env_steps += game.num_games
+        calls += 1
+        if calls % train_every == 0:
+            steps = agent.steps
+            agent.replay(gradient_steps)
+            if (agent.steps + 1) // 200 > (steps + 1) // 200:
+                agent.updateTargetNetwork()
+                env_sps, grad_sps = agent.throughput()
+                print(f"{torch.stack(tuple(rewards)).mean().item():.4f} | env steps/s: {env_sps:.0f} | grad steps/s: {grad_sps:.0f}")
+
 def testPerfNAI():
     game = Game()
     iterations = 10_000_000
     i = 0
     start_time = time.time()
-    game.getState()
+    game.getState(copy=False)
     while i < iterations:
         if game.AI_can_play:
             i+=1
             game.AIshootDEALER()
             
-            game.getState()
+            game.getState(copy=False)
         else: game.AI_can_play = True
         
         if game.DEALER_can_play:
@@ -675,7 +1956,333 @@ def testPerfNAI():
     print(f"Total steps: {iterations}")
     print(f"Total time: {total_time:.2f} seconds")
     print(f"Average steps per second: {final_sps:.2f}")
-         
+
+def testPerfVecGame(num_games: int = 4096):
+    """testPerfNAI for VecGame: every game shoots the DEALER each step."""
+    game = VecGame(num_games)
+    actions = np.zeros(num_games, dtype=np.int64)
+    iterations = 10_000_000
+    i = 0
+    start_time = time.time()
+    while i < iterations:
+        game.step(actions)
+        i += num_games
+        if i % (250 * num_games) == 0:
+            current_time = time.time() - start_time
+            print(f"Steps per second: {i / current_time:.2f}")
+
+    total_time = time.time() - start_time
+    print(f"\nFinal Performance:")
+    print(f"Games: {num_games}")
+    print(f"Total steps: {i}")
+    print(f"Total time: {total_time:.2f} seconds")
+    print(f"Average steps per second: {i / total_time:.2f}")
+
+def testReplayFootprint(transitions: int = 100_000):
+    """Bytes per transition of the old deque of (float16 state, action, reward, float16 next_state, done) tuples
+    against ReplayBuffer's float32 and compact storage, filled from the same Game transitions."""
+    import tracemalloc
+    game = Game()
+    tracemalloc.start()
+    memory = deque(maxlen=transitions)
+    state = game.getState()
+    while len(memory) < transitions:
+        action = random.randint(0, 7)
+        reward, done = game.step(action)
+        next_state = game.getState()
+        memory.append((state, action, reward, next_state, done))
+        state = next_state
+        if done:
+            game.resetGame()
+            state = game.getState()
+    deque_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    states, actions, rewards, next_states, dones = (np.array(field) for field in zip(*memory))
+    for compact in (False, True):
+        buffer = ReplayBuffer(transitions, game.state_size, compact=compact, device=torch.device("cpu"))
+        buffer.addBatch(states, actions, rewards, next_states, dones)
+        decoded = buffer._gather(torch.arange(transitions))
+        assert torch.allclose(decoded[0], torch.as_tensor(states, dtype=torch.float32), atol=1e-3)
+        print(f"ReplayBuffer(compact={compact}): {buffer.nbytes() / transitions:6.1f} bytes per transition")
+    print(f"deque of tuples:              {deque_bytes / transitions:6.1f} bytes per transition")
+
+def testPerfForward(batch_sizes=(1, 128, 4096), iterations: int = 200):
+    """Forward and forward+backward latency of DQNAgent's network: eager, TorchScript (trace) and torch.compile."""
+    model = SCDDDQN(24, 8, [128, 128, 128], skip_connections=[(0, 3), (1, 3)]).to(device)
+    variants = {"eager": model, "torchscript": model.trace(), "compile": torch.compile(model)}
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 24, device=device)
+        for name, net in variants.items():
+            for _ in range(10):
+                net(x).sum().backward()
+                with torch.no_grad():
+                    net(x)
+            start_time = time.perf_counter()
+            with torch.no_grad():
+                for _ in range(iterations):
+                    net(x)
+            forward = (time.perf_counter() - start_time) / iterations
+            start_time = time.perf_counter()
+            for _ in range(iterations):
+                net(x).sum().backward()
+            backward = (time.perf_counter() - start_time) / iterations
+            print(f"batch {batch_size:5d} {name:12s} forward {forward * 1e6:9.1f} us, forward+backward {backward * 1e6:9.1f} us")
+
+def testQuantizedPolicy(agent: DQNAgent = None, samples: int = 4096, iterations: int = 1000):
+    """Compare an agent's float model with its int8 copy on states sampled from its replay memory (filled from random
+    VecGame play if empty): Q-value error, greedy-action agreement, CPU latency and serialized size."""
+    if agent is None:
+        agent = DQNAgent(24, 8)
+    if len(agent.memory) < samples:
+        game = VecGame(samples, seed=0)
+        states = game.getState()
+        for _ in range(4):
+            actions = np.random.randint(0, 8, samples)
+            next_states, rewards, dones = game.step(actions)
+            agent.rememberBatch(states, actions, rewards, next_states, dones)
+            states = next_states
+    states = agent.memory.sample(samples)[0].cpu()
+
+    float_model = copy.deepcopy(agent.model).cpu().eval()
+    int8_model = quantizeForInference(agent.model)
+    with torch.no_grad():
+        q_float, q_int8 = float_model(states), int8_model(states)
+    error = (q_float - q_int8).abs()
+    print(f"Q-value error: mean {error.mean().item():.5f}, max {error.max().item():.5f} (Q range {q_float.min().item():.3f} to {q_float.max().item():.3f})")
+    print(f"Greedy action agreement: {(q_float.argmax(1) == q_int8.argmax(1)).float().mean().item() * 100:.2f}%")
+
+    for name, model in (("float32", float_model), ("int8", int8_model)):
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        latencies = []
+        for batch_size in (1, 128):
+            x = states[:batch_size]
+            with torch.no_grad():
+                for _ in range(10):
+                    model(x)
+                start_time = time.perf_counter()
+                for _ in range(iterations):
+                    model(x)
+            latencies.append((time.perf_counter() - start_time) / iterations * 1e6)
+        print(f"{name:8s} batch 1: {latencies[0]:7.1f} us, batch 128: {latencies[1]:7.1f} us, weights {buffer.tell() / 1024:.1f} KiB")
+
+def testLegalMasking(target_win_rate: float = 0.72, max_seconds: float = 600, num_games: int = 64,
+                     eval_every: int = 25_600, eval_games: int = 2000):
+    """Train one agent without and one with legal-action masking on a TorchVecGame (one gradient step per step call)
+    and report useful (legal) transitions per second of training time, and the training time until greedy play
+    (evaluatePolicy, masked like training) first reaches `target_win_rate`. Evaluation time is not counted."""
+    for mask_actions in (False, True):
+        torch.manual_seed(0)
+        agent = DQNAgent(24, 8)
+        game = TorchVecGame(num_games, seed=0)
+        state, mask = game.getState(), game.legalActions()
+        useful, trained, reached, next_eval = 0, 0.0, None, eval_every
+        win_rate = 0.0
+        while trained < max_seconds and reached is None:
+            start_time = time.time()
+            action = agent.actBatch(state, masks=mask if mask_actions else None)
+            useful += mask.gather(1, action.unsqueeze(1)).sum().item()
+            next_state, reward, done = game.step(action)
+            mask = game.legalActions()
+            agent.rememberBatch(state, action, reward, next_state, done, mask if mask_actions else None)
+            state = next_state
+            agent.env_steps += num_games
+            steps = agent.steps
+            agent.replay()
+            if (agent.steps + 1) // 200 > (steps + 1) // 200:
+                agent.updateTargetNetwork()
+            trained += time.time() - start_time
+            if agent.env_steps >= next_eval:
+                next_eval += eval_every
+                agent.model.eval()
+                win_rate = evaluatePolicy(agent, eval_games, masked=mask_actions, seed=1)
+                agent.model.train()
+                if win_rate >= target_win_rate:
+                    reached = trained
+        print(f"mask_actions={mask_actions}: {agent.env_steps / trained:.0f} env steps/s, {useful / trained:.0f} useful/s "
+              f"({useful / agent.env_steps * 100:.1f}% legal), win rate {win_rate * 100:.1f}% after {trained:.0f}s, "
+              + (f"reached {target_win_rate * 100:.0f}% after {reached:.0f}s" if reached is not None else "target not reached"))
+
+def testCheckpointerFailure(directory: str = "checkpoint_test"):
+    """A Checkpointer whose writes raise keeps running: the failure is counted, the next save() is accepted instead of
+    the writer looking busy forever, and close() returns. The directory is removed under it to make the writes fail."""
+    import shutil
+    agent = DQNAgent(24, 8)
+    checkpointer = Checkpointer(agent, directory)
+    shutil.rmtree(directory)
+    assert checkpointer.save(), "first save was refused"
+    checkpointer.pending.join()
+    assert checkpointer.failed == 1, "the failed write was not counted"
+    assert checkpointer.save(), "the writer still looks busy after a failed write"
+    closer = threading.Thread(target=checkpointer.close, daemon=True)
+    closer.start()
+    closer.join(timeout=30)
+    assert not closer.is_alive(), "close() hung after a failed write"
+    print(f"{checkpointer.failed} failed writes, close() returned")
+
+def testQCache(games: int = 2000, capacity: int = 10_000):
+    """Time single-state greedy acting through whole games, as humanVsAI and playGame do, with one eval-mode model
+    acting with and without a QCache over the same games, and report the cache's hit rate and evictions."""
+    agent = DQNAgent(24, 8)
+    agent.model.eval()
+    for cache in (None, QCache(capacity)):
+        agent.q_cache = cache
+        game = Game(dtype=np.float32)
+        random.seed(0)
+        start_time = time.time()
+        acted = 0
+        for _ in range(games):
+            game.resetGame()
+            done, turns, last_action = False, 0, None
+            while not done and turns < 200:
+                action = agent.act(game.getState(), "greedy")
+                # an untrained greedy model may insist on an item it does not hold, which is a no-op: shoot instead
+                if action == last_action and action not in (0, 7):
+                    action = 0
+                _, done = game.step(action)
+                last_action, turns, acted = action, turns + 1, acted + 1
+        elapsed = time.time() - start_time
+        print(f"{'QCache' if cache else 'no cache':8s}: {elapsed / acted * 1e6:7.1f} us per action", end="")
+        if cache is not None:
+            print(f", hit rate {cache.hitRate() * 100:.1f}%, {len(cache)} cached, {cache.evictions} evictions", end="")
+        print()
+
+def testPerfTargetUpdate(iterations: int = 2000, hard_every: int = 200, tau: float = 0.005):
+    """Per-call and per-gradient-step cost of a hard target copy (load_state_dict every `hard_every` steps) against a
+    soft update every step, fused (_foreach) and as a per-parameter loop, on DQNAgent's network."""
+    agent = DQNAgent(24, 8, target_tau=tau)
+    online, target = agent.online_parameters, agent.target_parameters
+
+    def loop():
+        with torch.no_grad():
+            for target_parameter, online_parameter in zip(target, online):
+                target_parameter.mul_(1 - tau).add_(online_parameter, alpha=tau)
+
+    def hard():
+        agent.target_model.load_state_dict(agent.model.state_dict())
+
+    for name, update, every in (("hard copy", hard, hard_every), ("soft, _foreach", agent.softUpdateTargetNetwork, 1),
+                                ("soft, loop", loop, 1)):
+        for _ in range(10):
+            update()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            update()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        per_call = (time.perf_counter() - start_time) / iterations
+        print(f"{name:15s}: {per_call * 1e6:8.1f} us per call, {per_call / every * 1e6:7.2f} us per gradient step")
+    print(f"{len(online)} parameter tensors, {sum(p.numel() for p in online)} values")
+
+def testPerfPrefetch(depths=(0, 1, 2, 4), steps: int = 2000, batch_size: int = 128, prioritized: bool = False):
+    """Gradient steps per second of replay() with memory filled from random VecGame play, sampling inline (depth 0)
+    and through a BatchPrefetcher of each depth, with the learner's stall time on the prefetch queue."""
+    game = VecGame(4096, seed=0)
+    states = game.getState()
+    transitions = []
+    for _ in range(25):
+        actions = np.random.randint(0, 8, 4096)
+        next_states, rewards, dones = game.step(actions)
+        transitions.append((states, actions, rewards, next_states, dones, game.legalActions()))
+        states = next_states
+    for depth in depths:
+        agent = DQNAgent(24, 8, prioritized=prioritized, prefetch_depth=depth)
+        agent.batch_size = batch_size
+        for transition in transitions:
+            agent.rememberBatch(*transition)
+        for _ in range(20):
+            agent.replay()
+        stall_time = agent.prefetcher.stall_time if agent.prefetcher is not None else 0.0
+        start_time = time.perf_counter()
+        for _ in range(steps):
+            agent.replay()
+        elapsed = time.perf_counter() - start_time
+        line = f"prefetch_depth {depth}: {steps / elapsed:7.1f} grad steps/s"
+        if agent.prefetcher is not None:
+            stall_time = agent.prefetcher.stall_time - stall_time
+            line += f", learner stalled {stall_time * 1e3:.0f} ms ({stall_time / elapsed * 100:.1f}%)"
+            agent.prefetcher.close()
+        print(line)
+
+def _weightLoadingWorker(path: str, hidden_dims: list, flat: bool, barrier, results):
+    model = SCDDDQN(24, 8, hidden_dims)
+    start_time = time.perf_counter()
+    if flat:
+        loadFlatWeights(model, path, inference_only=True)
+    else:
+        model.load_state_dict(torch.load(path))
+    elapsed = time.perf_counter() - start_time
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros(1, 24))
+    barrier.wait()  # every process holds its weights now, so shared pages are counted as shared
+    with open("/proc/self/smaps_rollup") as f:
+        pss = next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+    results.put((elapsed, pss))
+    barrier.wait()
+
+def testPerfWeightLoading(sizes=([128, 128, 128], [1024] * 4, [4096] * 4), processes: int = 4):
+    """Load time of a torch.save state_dict against a saveFlatWeights file for networks of growing size, each loaded
+    by `processes` processes at once, and their mean proportional set size (PSS: shared pages split between sharers)."""
+    import multiprocessing as mp
+    context = mp.get_context("fork")
+    for hidden_dims in sizes:
+        model = SCDDDQN(24, 8, hidden_dims)
+        megabytes = sum(tensor.nbytes for tensor in model.state_dict().values()) / 2**20
+        torch.save(model.state_dict(), "weights_test.pth")
+        saveFlatWeights(model, "weights_test.weights")
+        for flat, path in ((False, "weights_test.pth"), (True, "weights_test.weights")):
+            barrier, results = context.Barrier(processes), context.Queue()
+            workers = [context.Process(target=_weightLoadingWorker, args=(path, hidden_dims, flat, barrier, results)) for _ in range(processes)]
+            for worker in workers:
+                worker.start()
+            measured = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            load_time = sum(elapsed for elapsed, _ in measured) / processes
+            pss = sum(pss for _, pss in measured) / processes / 1024
+            print(f"{megabytes:7.1f} MiB {'flat mmap' if flat else 'torch.load':10s}: load {load_time * 1e3:8.2f} ms, PSS per process {pss:7.1f} MiB")
+        os.remove("weights_test.pth")
+        os.remove("weights_test.weights")
+
+def testFlatWeightsTraining(path: str = "weights_test.weights"):
+    """Check that an agent whose model was loaded from a saveFlatWeights file still trains: after one gradient step
+    its parameters have changed, and the optimizer and online_parameters still hold the model's own tensors."""
+    saveFlatWeights(DQNAgent(24, 8).model, path)
+    agent = DQNAgent(24, 8, target_tau=0.005)
+    loadFlatWeights(agent.model, path)
+    os.remove(path)
+    parameters = list(agent.model.parameters())
+    optimized = {id(parameter) for group in agent.optimizer.param_groups for parameter in group["params"]}
+    assert all(id(parameter) in optimized for parameter in parameters), "optimizer lost the model's parameters"
+    assert all(a is b for a, b in zip(parameters, agent.online_parameters)), "online_parameters lost the model's parameters"
+    game = VecGame(256, seed=0)
+    states = game.getState()
+    actions = np.random.randint(0, 8, 256)
+    next_states, rewards, dones = game.step(actions)
+    agent.rememberBatch(states, actions, rewards, next_states, dones, game.legalActions())
+    before = [parameter.detach().clone() for parameter in parameters]
+    agent.replay()
+    changed = sum(not torch.equal(old, parameter) for old, parameter in zip(before, agent.model.parameters()))
+    assert changed > 0, "a gradient step did not change the flat-loaded model"
+    print(f"{changed} of {len(parameters)} parameter tensors changed after one gradient step")
+
+def testPerfSumTree(capacities=(10_000, 100_000, 1_000_000, 4_000_000), batch_size: int = 128, iterations: int = 2_000):
+    """Time one prioritized sample + priority update of `batch_size` transitions as the tree grows."""
+    for capacity in capacities:
+        tree = SumTree(capacity)
+        tree.update(np.arange(capacity), np.random.random(capacity))
+        start_time = time.time()
+        for _ in range(iterations):
+            values = (np.arange(batch_size) + np.random.random(batch_size)) * (tree.total() / batch_size)
+            indices = tree.find(values)
+            tree.update(indices, np.random.random(batch_size))
+        per_batch = (time.time() - start_time) / iterations
+        print(f"Capacity {capacity:>10,}: {per_batch * 1e6:8.1f} us per batch ({per_batch / batch_size * 1e6:.2f} us per transition)")
+
 def testPerfAI():
     agent = DQNAgent(24, 8)
     game = Game()
@@ -743,10 +2350,24 @@ def testPerfAI():
     print(f"Total time: {total_time:.2f} seconds")
     print(f"Average steps per second: {final_sps:.1f}")
 
-def humanVsAI():
-    """Play against a trained AI agent."""
-    agent = DQNAgent(24, 8)
-    agent.loadModel()
+def humanVsAI(policy_path: str = None, quantized: bool = False, table_path: str = None, weights_path: str = None):
+    """Play against a trained AI agent; with `policy_path` the agent is a NumpyPolicy loaded from exportNumpyWeights output,
+    with `quantized` it acts through an int8 copy of the model, with `table_path` it is a PolicyTable from compilePolicy
+    (backed by the NumpyPolicy at `policy_path` for states the table misses, if given). `weights_path` maps the model's
+    weights from a saveFlatWeights file instead of unpickling the newest checkpoint."""
+    if table_path is not None:
+        agent = PolicyTable(table_path, fallback=None if policy_path is None else NumpyPolicy(policy_path))
+    elif policy_path is None:
+        agent = DQNAgent(24, 8, q_cache_size=10_000)
+        if weights_path is not None:
+            loadFlatWeights(agent.model, weights_path, inference_only=True)
+        else:
+            agent.loadModel()
+        agent.model.eval()
+        if quantized:
+            agent.useQuantizedPolicy()
+    else:
+        agent = NumpyPolicy(policy_path)
     game = Game()
     
     action_map = {
@@ -805,7 +2426,7 @@ def humanVsAI():
             if game.DEALER_can_play:
                 print("\nAI's turn...")
                 state = game.getState()
-                action = agent.act(state)
+                action = agent.act(state, "softmax")
                 
                 match action:
                     case 0:
@@ -853,23 +2474,65 @@ def humanVsAI():
 
 # Add this to the bottom of the file to allow running the game directly
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", help='checkpoint to resume training from, or "latest" for the newest one in models/checkpoints')
+    args = parser.parse_args()
+
     print("Choose an option:")
     print("1: Train AI")
     print("2: Play vs AI")
+    print("3: Export NumPy policy and mapped weights")
+    print("4: Play vs AI (NumPy policy)")
+    print("5: Play vs AI (int8 quantized)")
+    print("6: Compile policy table")
+    print("7: Play vs AI (policy table)")
+    print("8: Play vs AI (mapped weights from option 3)")
     
-    choice = input("Enter choice (1/2): ")
+    choice = input("Enter choice (1/2/3/4/5/6/7/8): ")
     if choice == "1":
         agent = DQNAgent(24, 8)
+        if args.resume is not None:
+            resume_path = args.resume
+            if resume_path == "latest":
+                checkpoints = listCheckpoints(os.path.join("models", "checkpoints"), agent.name)
+                resume_path = checkpoints[-1][1] if checkpoints else None
+            agent.loadModel(resume_path)
+        # created after loading, so the first checkpoint is due every_steps after the resumed step, not right away
+        checkpointer = Checkpointer(agent, every_steps=2_000, every_seconds=600, include_replay=True)
+        print(f"Replay memory: {agent.memory.capacity} transitions, {agent.memory.nbytes() / 2**20:.1f} MiB")
         e = 0
         start_time = time.time()
         time.sleep(1)
         while True:
             e += 1
             playGame(agent, Game())
+            checkpointer.maybeSave()
             #print(f"this took {time.time() - start_time} seconds, doing {agent.steps} steps, SPS = {agent.steps / (time.time() - start_time)}")
 
             if agent.steps > 17_000:
                 agent.saveModel()
                 break
+        checkpointer.close()
     elif choice == "2":
         humanVsAI()
+    elif choice == "3":
+        agent = DQNAgent(24, 8)
+        agent.loadModel()
+        exportNumpyWeights(agent.model, os.path.join("models", "policy.npz"))
+        saveFlatWeights(agent.model, os.path.join("models", "policy.weights"))
+        print("Policy written to models/policy.npz and models/policy.weights")
+    elif choice == "4":
+        humanVsAI(os.path.join("models", "policy.npz"))
+    elif choice == "5":
+        humanVsAI(quantized=True)
+    elif choice == "6":
+        agent = DQNAgent(24, 8)
+        agent.loadModel()
+        compilePolicy(agent.model, os.path.join("models", "policy_table.npz"))
+        evaluatePolicy(agent)
+        evaluatePolicy(PolicyTable(os.path.join("models", "policy_table.npz")))
+    elif choice == "7":
+        policy_path = os.path.join("models", "policy.npz")
+        humanVsAI(policy_path if os.path.exists(policy_path) else None, table_path=os.path.join("models", "policy_table.npz"))
+    elif choice == "8":
+        humanVsAI(weights_path=os.path.join("models", "policy.weights"))
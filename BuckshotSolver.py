@@ -0,0 +1,197 @@
+import sys
+import time
+import numpy as np
+import torch
+from BuckshotNLSCDDDQN import Game, DQNAgent, device
+
+# Full game state at an AI decision: the 24 getState fields plus the three flags getState leaves out.
+# AI_can_play is always True at a decision and current_round_num is always 0, so neither is part of the key.
+def stateKey(game: Game):
+    return (game.AI_hp, game.DEALER_hp, game.live_shells, game.blank_shells, game.shell, game.is_sawed, game.invert_odds,
+            game.DEALER_can_play, game.AI_did_play, game.DEALER_did_play, tuple(game.AI_items), tuple(game.DEALER_items))
+
+
+class Reload(Exception):
+    """Raised by ScriptedGame when the magazine runs out, which is the solver's horizon."""
+
+
+class ScriptedGame(Game):
+    def __init__(self):
+        """Game whose chance() outcomes follow `script` (an index per draw, 0 = True) instead of random numbers.
+        Every draw past the end of the script takes outcome 0 and is recorded in `branches`, so replaying the
+        trace with each alternative enumerates every outcome of a step exactly once; `probability` is the
+        product of the outcomes taken. Reloading raises Reload instead of drawing a new magazine and items."""
+        self.script, self.trace, self.branches, self.probability = [], [], [], 1.0
+        super().__init__()
+
+    def chance(self, p: float):
+        if p >= 1:
+            return True
+        if p <= 0:
+            return False
+        i = len(self.trace)
+        if i < len(self.script):
+            outcome = self.script[i]
+        else:
+            outcome = 0
+            self.branches.append(i)
+        self.trace.append(outcome)
+        self.probability *= p if outcome == 0 else 1 - p
+        return outcome == 0
+
+    def outOfShells(self):
+        raise Reload()
+
+    def AIshootAI(self):
+        self.shot_reward = super().AIshootAI()
+        return self.shot_reward
+
+    def AIshootDEALER(self):
+        self.shot_reward = super().AIshootDEALER()
+        return self.shot_reward
+
+    def load(self, key: tuple):
+        (self.AI_hp, self.DEALER_hp, self.live_shells, self.blank_shells, self.shell, self.is_sawed, self.invert_odds,
+         self.DEALER_can_play, self.AI_did_play, self.DEALER_did_play, AI_items, DEALER_items) = key
+        self.AI_items, self.DEALER_items = list(AI_items), list(DEALER_items)
+        self.writeItems(self.AI_items)
+        self.writeItems(self.DEALER_items)
+        self.AI_can_play = True
+        self.current_round_num = 0
+        self.shells = self.totalShells()
+
+
+class Solver():
+    def __init__(self, gamma: float = 0.92, leaf_value=None):
+        """Memoized expectimax over Game.step against DEALERalgo, using the rules themselves via ScriptedGame.
+
+        The horizon is the current magazine: a step that reloads ends in a leaf worth leaf_value(state) (0 by default;
+        pass the agent's V for a one-magazine lookahead), because the restock draws 3003^2 inventory pairs and the full
+        state space is far too large to enumerate. Within a magazine every valid action consumes a shell or an item, so
+        the only cycles are invalid actions that leave the state unchanged; those get Q = reward + gamma * V.
+        So the values are a horizon-limited approximation, on a different scale from a whole-game Q. `exact` marks the
+        states from which no line of play reaches a reload: only their values are the true optimum.
+        q() recurses once per step of a magazine, deeper than Python's default recursion limit allows; raise it with
+        sys.setrecursionlimit (10_000 is enough) before solving."""
+        self.gamma = gamma
+        self.leaf_value = leaf_value
+        self.game = ScriptedGame()
+        self.q_values = {}
+        self.exact = {}
+
+    def transitions(self, key: tuple, action: int):
+        """Every outcome of `action` in `key` as (probability, reward, done, next key or None if it reloaded, state at reload)."""
+        game = self.game
+        outcomes = []
+        scripts = [[]]
+        while scripts:
+            game.load(key)
+            game.script, game.trace, game.branches, game.probability = scripts.pop(), [], [], 1.0
+            try:
+                reward, done = game.step(action)
+                outcomes.append((game.probability, reward, done, None if done else stateKey(game), None))
+            except Reload:
+                # Mirrors the tail of Game.step: the reload happens after the AI's action (a beer on the last shell is always +1)
+                # or after the DEALER's reply, and the death checks still apply.
+                reward = 1 if action == 3 else game.shot_reward
+                if game.AI_hp <= 0:
+                    outcomes.append((game.probability, reward - 30, True, None, None))
+                elif game.DEALER_hp <= 0:
+                    outcomes.append((game.probability, reward + 25, True, None, None))
+                else:
+                    outcomes.append((game.probability, reward, False, None, game.getState()))
+            scripts.extend(game.trace[:i] + [1] for i in game.branches)
+        return outcomes
+
+    def q(self, key: tuple):
+        """The 8 action values of the state `key`."""
+        q_values = self.q_values.get(key)
+        if q_values is not None:
+            return q_values
+
+        q_values = np.zeros(8, dtype=np.float32)
+        self_loops = []
+        exact = True
+        for action in range(8):
+            outcomes = self.transitions(key, action)
+            if len(outcomes) == 1 and outcomes[0][3] == key:
+                self_loops.append((action, outcomes[0][1]))
+                continue
+            for probability, reward, done, next_key, leaf_state in outcomes:
+                if done:
+                    future = 0
+                elif next_key is None:
+                    future = self.leaf_value(leaf_state) if self.leaf_value is not None else 0
+                    exact = False
+                else:
+                    future = self.q(next_key).max()
+                    exact = exact and self.exact[next_key]
+                q_values[action] += probability * (reward + self.gamma * future)
+
+        value = max(q_values[action] for action in range(8) if action not in dict(self_loops))
+        for action, reward in self_loops:
+            q_values[action] = reward + self.gamma * value
+        self.q_values[key] = q_values
+        self.exact[key] = exact
+        return q_values
+
+    def save(self, path: str):
+        """Write the solved states as int8 getState codes (plus the hidden DEALER_can_play, AI_did_play, DEALER_did_play
+        flags), their float32 action values and `exact` flags, labelled with horizon="magazine"."""
+        keys = list(self.q_values)
+        scale = Game.stateScale(24)
+        codes, hidden = np.zeros((len(keys), 24), dtype=np.int8), np.zeros((len(keys), 3), dtype=np.int8)
+        for i, key in enumerate(keys):
+            self.game.load(key)
+            codes[i] = np.rint(self.game.getState().astype(np.float32) * scale)
+            hidden[i] = key[7:10]
+        np.savez_compressed(path, codes=codes, hidden=hidden, q_values=np.stack([self.q_values[key] for key in keys]),
+                            exact=np.array([self.exact[key] for key in keys]), gamma=self.gamma, horizon="magazine")
+
+
+def magazineStarts(num_starts: int, seed: int = None):
+    """Distinct AI decision states at the start of a magazine, collected from games played with random actions."""
+    random_state = np.random.default_rng(seed)
+    game = Game()
+    starts = {}
+    fresh = True
+    while len(starts) < num_starts:
+        if fresh:
+            starts[stateKey(game)] = None
+        shells = game.totalShells()
+        reward, done = game.step(int(random_state.integers(8)))
+        if done:
+            game.resetGame()
+        fresh = done or game.totalShells() > shells
+    return list(starts)
+
+
+def compareAgent(agent: DQNAgent, path: str, min_exact: int = 1000):
+    """Greedy agreement of an agent with a saved solver table, on the states whose values are exact (no reload reachable).
+    The other states' values are cut off at the reload and the agent's soft Q-values are on a different scale, so
+    neither regret nor Q-value correlation would mean anything. Warns when fewer than `min_exact` states are exact,
+    since the score then says little. Returns the agent's actions and agreement on those states."""
+    table = np.load(path)
+    exact = table["exact"]
+    states = table["codes"][exact].astype(np.float32) / Game.stateScale(24)
+    optimal = table["q_values"][exact].argmax(1)
+    with torch.no_grad():
+        actions = agent.model(torch.as_tensor(states, device=device)).argmax(1).cpu().numpy()
+    agreement = actions == optimal
+    print(f"Solver table: horizon {table['horizon']} (a horizon-limited approximation), {len(exact)} states, {exact.sum()} exact")
+    print(f"Greedy agreement with the solver on {exact.sum()} exact states: {agreement.mean() * 100 if len(agreement) else float('nan'):.2f}%")
+    if exact.sum() < min_exact:
+        print(f"Warning: only {exact.sum()} exact states (fewer than {min_exact}), solve more magazines for a meaningful score")
+    return actions, agreement
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(10_000)
+    solver = Solver()
+    start_time = time.time()
+    for i, key in enumerate(magazineStarts(200, seed=0)):
+        solver.q(key)
+        if (i + 1) % 50 == 0:
+            print(f"{i + 1} magazines, {len(solver.q_values)} states solved in {time.time() - start_time:.1f}s")
+    solver.save("solver_table.npz")
+    print(f"Saved {len(solver.q_values)} states ({sum(solver.exact.values())} exact, the rest horizon-limited) to solver_table.npz")
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class NumpyPolicy():
+    def __init__(self, path: str):
+        """Q-network inference with plain NumPy matmuls, from a file written by BuckshotNLSCDDDQN.exportNumpyWeights.
+
+        Needs no torch import, so actors and play mode start fast and stay small. Weights are stored pre-transposed
+        (in, out) and the dueling value/advantage heads are folded into one linear layer:
+        Q = V + A - mean(A) is linear in the last hidden features, so it is a single (hidden, actions) matmul."""
+        weights = np.load(path)
+        self.hidden = [(weights[f"hidden.{i}.weight"], weights[f"hidden.{i}.bias"]) for i in range(int(weights["num_hidden"]))]
+        self.projections = {int(i): (weights[f"skip.{i}.weight"], weights[f"skip.{i}.bias"]) for i in weights["projections"]}
+        self.skip_plan = [[] for _ in self.hidden]
+        for (to_layer, source, projection) in weights["skip_plan"]:
+            self.skip_plan[to_layer - 1].append((int(source), None if projection < 0 else int(projection)))
+        self.skip_sources = {source for skips in self.skip_plan for (source, _) in skips}
+
+        value_weight, value_bias = weights["value.weight"], weights["value.bias"]
+        advantage_weight, advantage_bias = weights["advantage.weight"], weights["advantage.bias"]
+        self.head_weight = value_weight + advantage_weight - advantage_weight.mean(axis=1, keepdims=True)
+        self.head_bias = value_bias + advantage_bias - advantage_bias.mean()
+        self.input_dim = self.hidden[0][0].shape[0]
+        self.outputs = self.head_bias.shape[0]
+        self.rng = np.random.default_rng()
+
+    def qValues(self, states):
+        """Q-values for a (N, inputs) batch or a single state, as float32."""
+        x = np.asarray(states, dtype=np.float32)
+        saved = {0: x} if 0 in self.skip_sources else {}
+        for i, ((weight, bias), skips) in enumerate(zip(self.hidden, self.skip_plan), 1):
+            x = np.maximum(x @ weight + bias, 0)
+            for (source, projection) in skips:
+                if projection is None:
+                    x = x + saved[source]
+                else:
+                    x = x + (saved[source] @ self.projections[projection][0] + self.projections[projection][1])
+            if i in self.skip_sources:
+                saved[i] = x
+        return x @ self.head_weight + self.head_bias
+
+    def actBatch(self, states, mode: str = "greedy", alpha: float = 1):
+        """One action per row: "greedy" takes argmax Q, "softmax" samples from softmax(Q / alpha) like DQNAgent.act."""
+        q_values = self.qValues(np.atleast_2d(states))
+        if mode == "greedy":
+            return q_values.argmax(axis=1)
+        if mode == "softmax":
+            logits = q_values / alpha
+            probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+            cumulative = probabilities.cumsum(axis=1)
+            draws = self.rng.random((len(q_values), 1)) * cumulative[:, -1:]
+            return (cumulative <= draws).sum(axis=1).clip(max=self.outputs - 1)
+        raise ValueError(f"Unknown action selection mode: {mode}")
+
+    def act(self, state, mode: str = "greedy", alpha: float = 1):
+        return int(self.actBatch(state, mode, alpha)[0])
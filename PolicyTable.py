@@ -0,0 +1,136 @@
+import numpy as np
+from StateEncoding import stateScale, stateOffset, stateLimits
+
+# Integer code of every getState field: field * SCALE + OFFSET, in 0 .. LIMITS - 1 (StateEncoding).
+# The key packs the 8 scalar codes and each inventory's 6 item counts (0-8) in mixed radix RADICES, ~1.1e17 in total;
+# 7**16 slot codes would not fit in an int64 next to them. SLOT_PLACES[slot, item] is what holding `item` in `slot`
+# adds to the key (the place of that inventory's count of it), so counting needs no one-hot pass.
+SCALE, OFFSET, LIMITS = stateScale(24), stateOffset(24), stateLimits(24)
+RADICES = np.array([6, 6, 10, 10, 3, 9, 2, 2] + [9] * 12, dtype=np.int64)
+PLACES = np.concatenate(([1], np.cumprod(RADICES[:-1]))).astype(np.int64)
+SLOT_PLACES = np.zeros((16, 7), dtype=np.int64)
+SLOT_PLACES[:8, 1:], SLOT_PLACES[8:, 1:] = PLACES[8:14], PLACES[14:20]
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def packStates(states):
+    """One int64 key per row of a (N, 24) batch or a single state; rows with a field out of range get -1."""
+    states = np.atleast_2d(states)
+    if states.shape[1] != 24:
+        raise ValueError(f"packStates needs 24-wide item slot states, not {states.shape[1]}")
+    codes = np.rint(states * SCALE).astype(np.int64) + OFFSET
+    valid = ((codes >= 0) & (codes < LIMITS)).all(axis=1)
+    codes[~valid] = 0
+    keys = codes[:, :8] @ PLACES[:8] + SLOT_PLACES[np.arange(16), codes[:, 8:]].sum(axis=1)
+    return np.where(valid, keys, -1)
+
+
+def unpackStates(keys):
+    """Inverse of packStates: the float32 getState vectors of (N,) keys."""
+    codes = np.asarray(keys, dtype=np.int64)[:, None] // PLACES % RADICES
+    counts = codes[:, 8:].reshape(-1, 2, 6)
+    filled = counts.cumsum(axis=2)
+    slots = ((filled[:, :, None, :] <= np.arange(8)[:, None]).sum(axis=3) + 1) * (np.arange(8) < filled[:, :, -1:])
+    return np.concatenate(((codes[:, :8] - OFFSET[:8]) / SCALE[:8], slots.reshape(-1, 16) / 6), axis=1).astype(np.float32)
+
+
+def hashSlots(keys, bits: int):
+    """Home slot of every key in a table of 2**bits slots (Fibonacci hashing)."""
+    return ((keys.astype(np.uint64) * HASH_MULTIPLIER) >> np.uint64(64 - bits)).astype(np.int64)
+
+
+def writePolicyTable(path: str, keys, q_values):
+    """Write unique packed states and their (N, actions) Q-values as an open-addressing hash table for PolicyTable:
+    2**bits slots (at most half full) of keys and row numbers, linear probing, built in vectorized rounds."""
+    keys = np.asarray(keys, dtype=np.int64)
+    bits = max(int(2 * len(keys) - 1).bit_length(), 4)
+    mask = (1 << bits) - 1
+    slot_keys = np.full(1 << bits, -1, dtype=np.int64)
+    slot_rows = np.full(1 << bits, -1, dtype=np.int32)
+    pending = np.arange(len(keys))
+    slots = hashSlots(keys, bits)
+    max_probe = 0
+    while len(pending):
+        # Every pending key whose slot is free claims it; when several want the same free slot the first one wins
+        # and the rest move on to the next slot with everyone else.
+        free = slot_keys[slots[pending]] == -1
+        _, first = np.unique(slots[pending[free]], return_index=True)
+        winners = pending[free][first]
+        slot_keys[slots[winners]] = keys[winners]
+        slot_rows[slots[winners]] = winners
+        placed = np.zeros(len(keys), dtype=bool)
+        placed[winners] = True
+        pending = pending[~placed[pending]]
+        slots[pending] = (slots[pending] + 1) & mask
+        max_probe += len(pending) > 0
+    q_values = np.asarray(q_values, dtype=np.float32)
+    np.savez(path, slot_keys=slot_keys, slot_rows=slot_rows, max_probe=max_probe,
+             q_values=q_values.astype(np.float16), actions=q_values.argmax(axis=1).astype(np.int8))
+
+
+class PolicyTable():
+    def __init__(self, path: str, fallback=None):
+        """Greedy actions and Q-values of a compiled network (BuckshotNLSCDDDQN.compilePolicy), looked up by packed state.
+
+        A lookup is a hash and a few probes, with no network evaluation. States missing from the table are answered by
+        `fallback` (anything with NumpyPolicy's qValues) if given, else by shooting the DEALER; `hits` and `misses` count them."""
+        table = np.load(path)
+        self.slot_keys, self.slot_rows = table["slot_keys"], table["slot_rows"]
+        self.max_probe = int(table["max_probe"])
+        self.q_values, self.actions = table["q_values"], table["actions"]
+        self.bits = len(self.slot_keys).bit_length() - 1
+        self.mask = len(self.slot_keys) - 1
+        self.outputs = self.q_values.shape[1]
+        self.fallback = fallback
+        self.rng = np.random.default_rng()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.q_values)
+
+    def rows(self, states):
+        """Row of every state in the table, -1 where it is missing."""
+        keys = packStates(states)
+        slots = hashSlots(keys, self.bits)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        pending = np.flatnonzero(keys >= 0)
+        for _ in range(self.max_probe + 1):
+            found = self.slot_keys[slots[pending]] == keys[pending]
+            rows[pending[found]] = self.slot_rows[slots[pending[found]]]
+            pending = pending[~found & (self.slot_keys[slots[pending]] != -1)]
+            if not len(pending):
+                break
+            slots[pending] = (slots[pending] + 1) & self.mask
+        missing = rows < 0
+        self.misses += int(missing.sum())
+        self.hits += len(rows) - int(missing.sum())
+        return rows
+
+    def qValues(self, states):
+        """Q-values for a (N, inputs) batch or a single state, as float32; missing states without a fallback get zeros."""
+        states = np.atleast_2d(states)
+        rows = self.rows(states)
+        q_values = self.q_values[rows].astype(np.float32)
+        missing = rows < 0
+        q_values[missing] = self.fallback.qValues(states[missing]) if self.fallback is not None and missing.any() else 0
+        return q_values
+
+    def actBatch(self, states, mode: str = "greedy", alpha: float = 1):
+        """One action per row, with the same modes as NumpyPolicy.actBatch; "greedy" reads the stored argmax."""
+        states = np.atleast_2d(states)
+        if mode == "softmax":
+            logits = self.qValues(states) / alpha
+            probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+            cumulative = probabilities.cumsum(axis=1)
+            draws = self.rng.random((len(logits), 1)) * cumulative[:, -1:]
+            return (cumulative <= draws).sum(axis=1).clip(max=self.outputs - 1)
+        if mode != "greedy":
+            raise ValueError(f"Unknown action selection mode: {mode}")
+        rows = self.rows(states)
+        actions = self.actions[rows].astype(np.int64)
+        missing = rows < 0
+        actions[missing] = self.fallback.qValues(states[missing]).argmax(axis=1) if self.fallback is not None and missing.any() else 0
+        return actions
+
+    def act(self, state, mode: str = "greedy", alpha: float = 1):
+        return int(self.actBatch(state, mode, alpha)[0])
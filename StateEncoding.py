@@ -0,0 +1,23 @@
+import numpy as np
+
+# Every getState field is an integer divided by its scale. Adding the offset makes every code >= 0: hp and shell
+# counts can reach -1. The limits are one past the largest code of each field: hp up to 4, shell counts up to 8
+# (an inverter can turn a whole magazine into one kind), shell 0/0.5/1, round number up to 8, two flags, then
+# 16 item slots (0-6) or, with count_encoding, 12 item counts (0-8).
+
+
+def stateScale(state_size: int):
+    """Per-field multipliers that turn a state vector (24 wide, or 20 with count_encoding) back into integers."""
+    items = [6] * 16 if state_size == 24 else [8] * 12
+    return np.array([4, 4, 4, 4, 2, 8, 1, 1] + items, dtype=np.float32)
+
+
+def stateOffset(state_size: int):
+    """Per-field offsets added to the stateScale integers."""
+    return np.array([1, 1, 1, 1] + [0] * (state_size - 4), dtype=np.int64)
+
+
+def stateLimits(state_size: int):
+    """Number of codes of every field once offset, so valid codes are 0 .. limit - 1."""
+    items = [7] * 16 if state_size == 24 else [9] * 12
+    return np.array([6, 6, 10, 10, 3, 9, 2, 2] + items, dtype=np.int64)
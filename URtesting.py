@@ -4,10 +4,10 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from collections import deque
 import time
 import multiprocessing as mp
-from multiprocessing import Queue, Event
+from multiprocessing import Event, shared_memory
+from BuckshotNLSCDDDQN import ReplayBuffer, MemmapReplayBuffer, loadFlatWeights
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu"); print(f"Using: {device}")
 
@@ -283,6 +283,7 @@ class NoisyLinear(nn.Module):
         self.register_buffer("bias_epsilon", torch.empty(self.out_features, device=device))
         self.std_init = std_init
         self.reset_parameters()
+        self.reset_noise()
 
     def reset_parameters(self):
         bound = 1 / self.weight_mu.size(1) ** 0.5
@@ -291,9 +292,20 @@ class NoisyLinear(nn.Module):
         self.bias_mu.data.uniform_(-bound, bound)
         self.bias_sigma.data.fill_(self.std_init / self.bias_mu.size(0) ** 0.5)
 
+    @staticmethod
+    def scaleNoise(size: int):
+        x = torch.randn(size, device=device)
+        return x.sign() * x.abs().sqrt()
+
+    def reset_noise(self):
+        """Factorized Gaussian noise: in + out draws, combined as an outer product, kept until the next reset_noise()."""
+        epsilon_in, epsilon_out = self.scaleNoise(self.in_features), self.scaleNoise(self.out_features)
+        self.weight_epsilon.copy_(torch.outer(epsilon_out, epsilon_in))
+        self.bias_epsilon.copy_(epsilon_out)
+
     def forward(self, x):
-        self.weight_epsilon.normal_()
-        self.bias_epsilon.normal_()
+        if not self.training:
+            return torch.nn.functional.linear(x, self.weight_mu, self.bias_mu)
         weight = self.weight_mu + self.weight_sigma * self.weight_epsilon
         bias = self.bias_mu + self.bias_sigma * self.bias_epsilon
         return torch.nn.functional.linear(x, weight, bias)
@@ -330,6 +342,11 @@ class NLSCDDDQN(nn.Module):
                     self.skip_projections.append(projection_layer)
                 else: self.skip_projections.append(None)
 
+    def reset_noise(self):
+        """Resample the noise of every NoisyLinear layer; forwards reuse it until the next call."""
+        for module in self.modules():
+            if isinstance(module, NoisyLinear): module.reset_noise()
+
     def forward(self, x):
         outputs = [x]
         for i, layer in enumerate(self.hidden_layers):
@@ -352,18 +369,22 @@ class NLSCDDDQN(nn.Module):
         return q_values
 
 class DQNAgent:
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, *, replay_dir=None):
         self.name = "Buck_NLSCDDDQN_v1a.2.1"
         self.inputs, self.outputs = inputs, outputs
         self.batch_size = 3200000
-        self.memory = deque(maxlen=100_000)
-        self.model = NLSCDDDQN(inputs, outputs, [80, 80, 80], skip_connections=[(0,3)], use_noisy=True).to(device)
-        self.target_model = NLSCDDDQN(inputs, outputs, [80, 80, 80], skip_connections=[(0,3)], use_noisy=True).to(device)
+        # Not compact: this file's Game lets blank_shells reach -2, which has no 4-bit code
+        self.memory = MemmapReplayBuffer(10_000_000, inputs, directory=replay_dir) if replay_dir else ReplayBuffer(100_000, inputs)
+        self.model = self.buildModel(inputs, outputs)
+        self.target_model = self.buildModel(inputs, outputs)
         self.optimizer = optim.Adam(self.model.parameters(), lr=0.001)
         self.loss_fn = nn.MSELoss().to(device)
         self.steps = 0
         self.updateTargetNetwork()
 
+    @staticmethod
+    def buildModel(inputs, outputs): return NLSCDDDQN(inputs, outputs, [80, 80, 80], skip_connections=[(0,3)], use_noisy=True).to(device)
+
     def updateTargetNetwork(self): self.target_model.load_state_dict(self.model.state_dict())
 
     def act(self, state):
@@ -373,21 +394,14 @@ class DQNAgent:
         with torch.no_grad(): q_values = self.model(state)
         return torch.argmax(q_values).item()
 
-    def remember(self, state, action, reward, next_state, done):
-        experience = (state, action, reward, next_state, done)
-        self.memory.append(experience)
+    def remember(self, state, action, reward, next_state, done): self.memory.add(state, action, reward, next_state, done)
 
     def replay(self):
         self.steps += 1
         if len(self.memory) < self.batch_size: return
+        self.model.reset_noise(); self.target_model.reset_noise()
         
-        batch = random.sample(self.memory, self.batch_size)
-        states, actions, rewards, next_states, dones = zip(*batch)
-        states = torch.FloatTensor(np.array(states)).to(device)
-        actions = torch.LongTensor(actions).unsqueeze(1).to(device)
-        rewards = torch.FloatTensor(rewards).to(device)
-        next_states = torch.FloatTensor(np.array(next_states)).to(device)
-        dones = torch.FloatTensor(dones).to(device)
+        states, actions, rewards, next_states, dones, _ = self.memory.sample(self.batch_size)
         q_values = self.model(states).gather(1, actions).squeeze()
         with torch.no_grad():
             max_next_q_values = self.target_model(next_states).max(1)[0]
@@ -407,6 +421,7 @@ class DQNAgent:
             'optimizer_state_dict': self.optimizer.state_dict(),
             'steps': self.steps,
         }, model_path)
+        self.memory.flush()
 
     def loadModel(self):
         filename = f"{self.name}_{self.steps}.pth"
@@ -421,45 +436,217 @@ class DQNAgent:
             print(f"Model loaded from {model_path}")
         else: raise Exception(f"Model not found in {model_path}")
     
+class ExperienceRing:
+    def __init__(self, capacity: int, state_size: int, name: str = None):
+        """ Single-producer single-consumer ring of transitions in one multiprocessing.shared_memory block \n
+        ------------- \n
+        The worker only advances head (transitions written) and the learner only advances tail (transitions consumed).
+        Each is an aligned int64 with a single writer, published after the data it covers, so no lock is needed on x86. \n
+        Pickling sends only the block's name, so a spawned worker attaches to the same memory. """
+        self.capacity, self.state_size = capacity, state_size
+        fields = [("actions", np.int64, (capacity,)), ("states", np.float32, (capacity, state_size)),
+                  ("next_states", np.float32, (capacity, state_size)), ("rewards", np.float32, (capacity,)), ("dones", np.bool_, (capacity,))]
+        nbytes = [np.dtype(dtype).itemsize * int(np.prod(shape)) for _, dtype, shape in fields]
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=16 + sum(nbytes))
+        self.indices = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+        offset = 16
+        for (field, dtype, shape), size in zip(fields, nbytes):
+            setattr(self, field, np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset))
+            offset += size
+
+    def __reduce__(self): return (ExperienceRing, (self.capacity, self.state_size, self.shm.name))
+
+    def put(self, state, action, reward, next_state, done):
+        """Write one transition; returns False without writing if the learner has not freed a slot yet."""
+        head = int(self.indices[0])
+        if head - self.indices[1] >= self.capacity: return False
+        i = head % self.capacity
+        self.states[i], self.actions[i], self.rewards[i], self.next_states[i], self.dones[i] = state, action, reward, next_state, done
+        self.indices[0] = head + 1
+        return True
+
+    def drain(self, memory):
+        """Hand every transition written since the last drain to memory.addBatch as views of the ring (at most two chunks), return the count.
+        memory=None just discards them (benchmarks)."""
+        tail, head = int(self.indices[1]), int(self.indices[0])
+        start, n = tail % self.capacity, head - tail
+        first = min(n, self.capacity - start)
+        for lo, hi in ((start, start + first), (0, n - first)):
+            if hi > lo and memory is not None: memory.addBatch(self.states[lo:hi], self.actions[lo:hi], self.rewards[lo:hi], self.next_states[lo:hi], self.dones[lo:hi])
+        self.indices[1] = head
+        return n
+
+    def close(self, unlink: bool = False):
+        del self.indices, self.actions, self.states, self.next_states, self.rewards, self.dones
+        self.shm.close()
+        if unlink: self.shm.unlink()
+
+class SharedWeights:
+    def __init__(self, numel: int, name: str = None):
+        """ A model's parameters as one flat float32 vector in multiprocessing.shared_memory, behind an int64 version \n
+        ------------- \n
+        The version is odd while publish() is writing (a seqlock): pull() copies only when it sees a new even version,
+        and retries if the version moved during its copy. Pickling sends only the block's name. """
+        self.numel = numel
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=8 + 4 * numel)
+        self.version = np.ndarray(1, dtype=np.int64, buffer=self.shm.buf)
+        self.flat = torch.from_numpy(np.ndarray(numel, dtype=np.float32, buffer=self.shm.buf, offset=8))
+        self.local_version = 0
+
+    @classmethod
+    def forModel(cls, model: nn.Module): return cls(sum(p.numel() for p in model.parameters()))
+
+    def __reduce__(self): return (SharedWeights, (self.numel, self.shm.name))
+
+    def publish(self, model: nn.Module):
+        """Learner side: copy the parameters into the shared vector under a new version."""
+        self.version[0] += 1
+        offset = 0
+        for p in model.parameters():
+            self.flat[offset:offset + p.numel()].copy_(p.detach().view(-1))
+            offset += p.numel()
+        self.version[0] += 1
+
+    def pull(self, model: nn.Module):
+        """Actor side: copy in place into `model` if a newer version was published; returns whether it did."""
+        while True:
+            version = int(self.version[0])
+            if version == self.local_version or version % 2: return False
+            offset = 0
+            with torch.no_grad():
+                for p in model.parameters():
+                    p.copy_(self.flat[offset:offset + p.numel()].view_as(p))
+                    offset += p.numel()
+            if int(self.version[0]) == version:
+                self.local_version = version
+                return True
+
+    def close(self, unlink: bool = False):
+        del self.version, self.flat
+        self.shm.close()
+        if unlink: self.shm.unlink()
+
+class InferenceSlots:
+    def __init__(self, num_actors: int, state_size: int, name: str = None):
+        """ One request/response slot per actor in multiprocessing.shared_memory \n
+        ------------- \n
+        An actor writes its state, then bumps its request counter and waits for the server to write the action and
+        bump the matching response counter. Every counter has a single writer, so as with ExperienceRing no lock is needed. """
+        self.num_actors, self.state_size = num_actors, state_size
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=8 * 3 * num_actors + 4 * num_actors * state_size)
+        self.requests, self.responses, self.actions = (np.ndarray(num_actors, dtype=np.int64, buffer=self.shm.buf, offset=8 * num_actors * i) for i in range(3))
+        self.states = np.ndarray((num_actors, state_size), dtype=np.float32, buffer=self.shm.buf, offset=8 * 3 * num_actors)
+
+    def __reduce__(self): return (InferenceSlots, (self.num_actors, self.state_size, self.shm.name))
+
+    def request(self, actor: int, state, stop_event: Event = None):
+        """Actor side: submit a state and wait for its action; None if stop_event is set first."""
+        self.states[actor] = state
+        sequence = self.requests[actor] + 1
+        self.requests[actor] = sequence
+        while self.responses[actor] != sequence:
+            if stop_event is not None and stop_event.is_set(): return None
+            time.sleep(0)
+        return int(self.actions[actor])
+
+    def pending(self): return np.flatnonzero(self.requests != self.responses)
+
+    def respond(self, actors, actions):
+        """Server side: write the actions, then release the actors that asked for them."""
+        self.actions[actors] = actions
+        self.responses[actors] = self.requests[actors]
+
+    def close(self, unlink: bool = False):
+        del self.requests, self.responses, self.actions, self.states
+        self.shm.close()
+        if unlink: self.shm.unlink()
+
+class InferenceServer:
+    def __init__(self, slots: InferenceSlots, stop_event: Event, shared_weights: SharedWeights, *, max_latency: float = 0.001):
+        """ Answers every actor's InferenceSlots request with one batched forward pass \n
+        ------------- \n
+        Once a request arrives the server waits until every actor is waiting or `max_latency` seconds have passed,
+        whichever is first, then runs the whole batch. """
+        self.slots = slots
+        self.stop_event = stop_event
+        self.shared_weights = shared_weights
+        self.max_latency = max_latency
+
+    def run(self):
+        self.model = DQNAgent.buildModel(24, 8)
+        while not self.stop_event.is_set():
+            self.shared_weights.pull(self.model)
+            pending = self.slots.pending()
+            if len(pending) == 0:
+                time.sleep(0)
+                continue
+            deadline = time.perf_counter() + self.max_latency
+            while len(pending) < self.slots.num_actors and time.perf_counter() < deadline:
+                time.sleep(0)
+                pending = self.slots.pending()
+            states = torch.as_tensor(self.slots.states[pending], device=device)
+            self.model.reset_noise()
+            with torch.no_grad(): q_values = self.model(states)
+            self.slots.respond(pending, q_values.argmax(1).cpu().numpy())
+
 class Worker:
-    def __init__(self, worker_id: int, experience_queue: Queue, stop_event: Event, 
-                 model_update_event: Event, shared_model_state):
+    def __init__(self, worker_id: int, experience_ring: ExperienceRing, stop_event: Event, shared_weights: SharedWeights,
+                 inference_slots: InferenceSlots = None, weights_path: str = None):
+        """ weights_path: start from a saveFlatWeights file, memory-mapped so every worker shares its pages;
+        with shared_weights=None the worker keeps acting with those weights. """
         self.worker_id = worker_id
-        self.experience_queue = experience_queue
+        self.weights_path = weights_path
+        self.experience_ring = experience_ring
         self.stop_event = stop_event
-        self.model_update_event = model_update_event
-        self.shared_model_state = shared_model_state
+        self.shared_weights = shared_weights
+        self.inference_slots = inference_slots
         self.game = Game()
-        self.local_agent = DQNAgent(24, 8)
+
+    def act(self, state):
+        if self.inference_slots is not None: return self.inference_slots.request(self.worker_id, state, self.stop_event)
+        # pull() is a single version read unless the learner published, so a long game still picks up new weights
+        if self.shared_weights is not None: self.shared_weights.pull(self.model)
+        # fresh noise for every action: with frozen noise a greedy no-op (an item it does not hold) repeats forever
+        self.model.reset_noise()
+        state = torch.as_tensor(state, dtype=torch.float32, device=device).unsqueeze(0)
+        with torch.no_grad(): q_values = self.model(state)
+        return torch.argmax(q_values).item()
     
+    def playTurn(self, state, max_steps: int = None):
+        """Act until the AI shoots, writing every transition to the ring; returns the number of actions taken, or None
+        if stopped first. With max_steps the turn is abandoned after that many actions (testWorkerTurns)."""
+        steps, done, turn_done = 0, False, False
+        while not turn_done and (max_steps is None or steps < max_steps):
+            action = self.act(state)
+            if action is None: return None
+            reward = 0
+            
+            match action:
+                case 0: reward = self.game.AIshootDEALER(); turn_done = True
+                case 1: reward = self.game.smoke(player=True)
+                case 2: reward = self.game.magnifier(player=True)
+                case 3: reward = self.game.drinkBeer(player=True)
+                case 4: reward = self.game.inverter(player=True)
+                case 5: reward = self.game.cuff(player=True)
+                case 6: reward = self.game.saw(player=True)
+                case 7: reward = self.game.AIshootAI(); turn_done = True
+            
+            next_state = self.game.getState()
+            while not self.experience_ring.put(state, action, reward, next_state, done):
+                if self.stop_event.is_set(): return None
+                time.sleep(0.0001)
+            state = next_state
+            steps += 1
+        return steps
+
     def run(self):
+        self.model = DQNAgent.buildModel(24, 8) if self.inference_slots is None else None
+        if self.model is not None and self.weights_path is not None: loadFlatWeights(self.model, self.weights_path, inference_only=True)
         while not self.stop_event.is_set():
-            if self.model_update_event.is_set():
-                self.local_agent.model.load_state_dict(self.shared_model_state)
-                self.model_update_event.clear()
-            
             self.game.resetGame()
-            state = self.game.getState()
-            done = turn_done = False
             
             if self.game.AI_can_play:
-                while not turn_done:
-                    action = self.local_agent.act(state)
-                    reward = 0
-                    
-                    match action:
-                        case 0: reward = self.game.AIshootDEALER(); turn_done = True
-                        case 1: reward = self.game.smoke(player=True)
-                        case 2: reward = self.game.magnifier(player=True)
-                        case 3: reward = self.game.drinkBeer(player=True)
-                        case 4: reward = self.game.inverter(player=True)
-                        case 5: reward = self.game.cuff(player=True)
-                        case 6: reward = self.game.saw(player=True)
-                        case 7: reward = self.game.AIshootAI(); turn_done = True
-                    
-                    next_state = self.game.getState()
-                    self.experience_queue.put((state, action, reward, next_state, done))
-                    state = next_state
+                if self.playTurn(self.game.getState()) is None: return
             else:
                 self.game.AI_can_play = True
             
@@ -468,19 +655,27 @@ class Worker:
             else:
                 self.game.DEALER_can_play = True
 
-def train_parallel(num_processes=4):
-    experience_queue = Queue()
+def train_parallel(num_processes=4, ring_capacity=65_536, inference_server=False, weights_path=None):
+    experience_rings = [ExperienceRing(ring_capacity, 24) for _ in range(num_processes)]
+    inference_slots = InferenceSlots(num_processes, 24) if inference_server else None
     stop_event = Event()
-    model_update_event = Event()
     
     # Create shared model state
-    agent = DQNAgent(24, 8)
-    shared_model_state = agent.model.state_dict()
+    agent = DQNAgent(24, 8, replay_dir="replay")
+    if weights_path is not None:
+        loadFlatWeights(agent.model, weights_path)
+        agent.updateTargetNetwork()
+    shared_weights = SharedWeights.forModel(agent.model)
+    shared_weights.publish(agent.model)
     
     # Create and start workers
     workers = []
+    if inference_server:
+        p = mp.Process(target=InferenceServer(inference_slots, stop_event, shared_weights).run)
+        workers.append(p)
+        p.start()
     for i in range(num_processes):
-        worker = Worker(i, experience_queue, stop_event, model_update_event, shared_model_state)
+        worker = Worker(i, experience_rings[i], stop_event, shared_weights, inference_slots, weights_path)
         p = mp.Process(target=worker.run)
         workers.append(p)
         p.start()
@@ -491,17 +686,14 @@ def train_parallel(num_processes=4):
     try:
         while agent.steps < 1_000_000:
             # Collect experiences from workers
-            while not experience_queue.empty():
-                state, action, reward, next_state, done = experience_queue.get()
-                agent.remember(state, action, reward, next_state, done)
+            for ring in experience_rings: ring.drain(agent.memory)
             
             # Training
             agent.replay()
             
             if agent.steps % 300 == 0:
                 agent.updateTargetNetwork()
-                shared_model_state = agent.model.state_dict()
-                model_update_event.set()
+                shared_weights.publish(agent.model)
             
             if agent.steps % 1000 == 0:
                 current_sps = agent.steps / (time.time() - start_time)
@@ -512,9 +704,59 @@ def train_parallel(num_processes=4):
         agent.saveModel()
         
     finally:
+        agent.memory.flush()
         stop_event.set()
         for p in workers:
             p.join()
+        for ring in experience_rings: ring.close(unlink=True)
+        if inference_slots is not None: inference_slots.close(unlink=True)
+        shared_weights.close(unlink=True)
+
+def testPerfInference(actor_counts=(1, 4, 16, 64), seconds: float = 5.0):
+    """Actor transitions per second with per-worker inference against one InferenceServer, for each number of actors."""
+    model = DQNAgent.buildModel(24, 8)
+    for num_actors in actor_counts:
+        for inference_server in (False, True):
+            rings = [ExperienceRing(65_536, 24) for _ in range(num_actors)]
+            slots = InferenceSlots(num_actors, 24) if inference_server else None
+            weights = SharedWeights.forModel(model)
+            weights.publish(model)
+            stop_event = Event()
+            processes = [mp.Process(target=InferenceServer(slots, stop_event, weights).run)] if inference_server else []
+            processes += [mp.Process(target=Worker(i, rings[i], stop_event, weights, slots).run) for i in range(num_actors)]
+            for p in processes: p.start()
+            while any(ring.drain(None) == 0 for ring in rings): time.sleep(0.1)
+
+            transitions, start_time = 0, time.time()
+            while time.time() - start_time < seconds:
+                transitions += sum(ring.drain(None) for ring in rings)
+                time.sleep(0.01)
+            elapsed = time.time() - start_time
+            stop_event.set()
+            for p in processes: p.join()
+            for ring in rings: ring.close(unlink=True)
+            if slots is not None: slots.close(unlink=True)
+            weights.close(unlink=True)
+            print(f"{num_actors:3d} actors, {'inference server' if inference_server else 'per-worker model'}: {transitions / elapsed:10.0f} transitions/s")
+
+def testWorkerTurns(turns: int = 200, max_steps: int = 1000):
+    """Play `turns` turns of a Worker with a fresh untrained model and check that every one ends within max_steps actions."""
+    model = DQNAgent.buildModel(24, 8)
+    weights = SharedWeights.forModel(model)
+    weights.publish(model)
+    ring = ExperienceRing(max_steps, 24)
+    worker = Worker(0, ring, Event(), weights)
+    worker.model = model
+    lengths = []
+    for _ in range(turns):
+        worker.game.resetGame()
+        lengths.append(worker.playTurn(worker.game.getState(), max_steps))
+        ring.drain(None)
+    ring.close(unlink=True)
+    weights.close(unlink=True)
+    stuck = sum(length >= max_steps for length in lengths)
+    print(f"{turns} turns: {np.mean(lengths):.1f} actions on average, longest {max(lengths)}, {stuck} cut off at {max_steps}")
+    assert stuck == 0, f"{stuck} of {turns} worker turns did not end within {max_steps} actions"
 
 if __name__ == "__main__":
     # Set start method for multiprocessing